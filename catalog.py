@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import os
+import json
+import threading
+import logging
+import traceback
+from time import monotonic
+
+LOGGER = logging.getLogger('zigate')
+
+RELOAD_INTERVAL = 10  # seconds between checks of templates directory
+
+
+class TemplateCatalog(object):
+    '''
+    Device templates loaded once from a directory
+    indexed by filename (modelIdentifier or manufacturer_code/endpoints fingerprint)
+    and by modelIdentifier found in template
+    factory builds the template object from json data
+    '''
+    def __init__(self, path, factory):
+        self.path = path
+        self._factory = factory
+        self._templates = None  # filename: template
+        self._models = {}  # modelIdentifier: filename
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _model_identifier(self, data):
+        for ep in data.get('endpoints', []):
+            for cluster in ep.get('clusters', []):
+                if cluster.get('cluster') != 0:
+                    continue
+                for attribute in cluster.get('attributes', []):
+                    if attribute.get('attribute') == 5:
+                        return attribute.get('data')
+
+    def reload(self):
+        '''
+        (re)load all templates
+        '''
+        with self._lock:
+            mtime = self._dir_mtime()
+            templates = {}
+            models = {}
+            try:
+                filenames = os.listdir(self.path)
+            except OSError:
+                LOGGER.warning('Templates directory %s not found', self.path)
+                filenames = []
+            for filename in sorted(filenames):
+                name, ext = os.path.splitext(filename)
+                if ext != '.json':
+                    continue
+                try:
+                    with open(os.path.join(self.path, filename)) as fp:
+                        data = json.load(fp)
+                    templates[name] = self._factory(data)
+                    model = self._model_identifier(data)
+                    if model:
+                        models.setdefault(model.replace(' ', '_').replace('/', '_'), name)
+                except Exception:
+                    LOGGER.error('Failed to load template for {}'.format(name))
+                    LOGGER.error(traceback.format_exc())
+            self._templates = templates
+            self._models = models
+            self._mtime = mtime
+            self._checked = monotonic()
+            LOGGER.debug('%s templates loaded', len(templates))
+
+    def _check(self):
+        if self._templates is None:
+            self.reload()
+        elif monotonic() - self._checked > RELOAD_INTERVAL:
+            self._checked = monotonic()
+            if self._dir_mtime() != self._mtime:
+                LOGGER.debug('Templates directory changed, reload')
+                self.reload()
+
+    def get(self, name):
+        '''
+        return template matching filename or modelIdentifier
+        '''
+        self._check()
+        template = self._templates.get(name)
+        if template is None and name in self._models:
+            template = self._templates.get(self._models[name])
+        return template
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        self._check()
+        return len(self._templates)
@@ -47,10 +47,26 @@ LOGGER = logging.getLogger('zigate')
 #             }
 
 CLUSTERS = {}
+VALUE_FUNCTIONS = {}  # expression: function(value, self)
+
+
+def compile_value(expression):
+    '''
+    return function computing attribute value from expression
+    compiled once and cached
+    '''
+    func = VALUE_FUNCTIONS.get(expression)
+    if func is None:
+        code = compile('lambda value, self: ({})'.format(expression), '<value>', 'eval')
+        func = eval(code, globals())
+        VALUE_FUNCTIONS[expression] = func
+    return func
 
 
 def register_cluster(o):
     CLUSTERS[o.cluster_id] = o
+    for attr_def in o.attributes_def.values():
+        compile_value(attr_def['value'])
     return o
 
 
@@ -78,6 +94,13 @@ class Cluster(object):
         self._endpoint = endpoint
         self._device = device
 
+    def resolve_def(self, data):
+        '''
+        hook choosing attributes_def of attribute data,
+        called by update and when loading a snapshot
+        '''
+        pass
+
     def update(self, data):
         attribute_id = data['attribute']
         added = False
@@ -102,10 +125,8 @@ class Cluster(object):
                     attribute['value'] = attribute_type()
             else:
                 try:
-                    attribute['value'] = eval(attribute['value'],
-                                              globals(),
-                                              {'value': attribute['data'],
-                                               'self': self})
+                    # expressions not known at registration are compiled on first use
+                    attribute['value'] = compile_value(attribute['value'])(attribute['data'], self)
                     if attribute.get('inverse', False) and isinstance(attribute['value'], bool):
                         attribute['value'] = not attribute['value']
                 except Exception:
@@ -140,6 +161,37 @@ class Cluster(object):
             cluster.update(attribute)
         return cluster
 
+    def to_snapshot(self):
+        '''
+        return attributes without keys coming from attributes_def
+        '''
+        attributes = []
+        for attribute_id, attribute in self.attributes.items():
+            attr_def = self.attributes_def.get(attribute_id, {})
+            attributes.append({k: v for k, v in attribute.items()
+                               if k in ('attribute', 'data', 'value') or
+                               k not in attr_def or attr_def[k] != v})
+        return (self.cluster_id, attributes)
+
+    @staticmethod
+    def from_snapshot(data, endpoint=None, device=None):
+        '''
+        rebuild cluster from attributes already decoded,
+        value expressions are not evaluated again
+        '''
+        cluster_id, attributes = data
+        cluster = get_cluster(cluster_id, endpoint, device)
+        for attribute in attributes:
+            cluster.resolve_def(attribute)
+            attribute_id = attribute['attribute']
+            attr_def = cluster.attributes_def.get(attribute_id)
+            if attr_def:
+                attr = dict(attr_def)
+                attr.update(attribute)
+                attribute = attr
+            cluster.attributes[attribute_id] = attribute
+        return cluster
+
     def get_attribute(self, attribute_id):
         return self.attributes.get(attribute_id, {})
 
@@ -246,12 +298,15 @@ class C0006(Cluster):
                                'type': str, 'expire': 2}
                       }
 
-    def update(self, data):
+    def resolve_def(self, data):
         # handle multiclick konke
         if data['attribute'] == 0x0000 and not isinstance(data.get('data', False), bool):
             if self.attributes_def[0x0000]['name'] != 'multiclick':
                 self.attributes_def = self.attributes_def.copy()
                 self.attributes_def[0x0000] = {'name': 'multiclick', 'value': 'value', 'type': int}
+
+    def update(self, data):
+        self.resolve_def(data)
         return Cluster.update(self, data)
 
 
@@ -540,14 +595,17 @@ class C0500(Cluster):
         if 'zone_id' not in data:  # loaded from persistent
             data['zone_id'] = data['attribute']
             data['zone_status'] = data.get('data', '0000000000')
-        zone_id = data['zone_id']
-        data['attribute'] = zone_id
+        data['attribute'] = data['zone_id']
         data['data'] = data['zone_status']
+        self.resolve_def(data)
+        r = Cluster.update(self, data)
+        return r
+
+    def resolve_def(self, data):
+        zone_id = data['attribute']
         # if zone_id is unknown, clone defaut zone
         if zone_id not in self.attributes_def:
             self.attributes_def[zone_id] = self.attributes_def[255]
-        r = Cluster.update(self, data)
-        return r
 
     def _decode(self, zone_status):
         if isinstance(zone_status, dict):
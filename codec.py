@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+'''
+ZiGate serial protocol codec
+
+frame format is 0x01 + escaped(msg_type, length, checksum, payload) + 0x03
+where every byte lower than 0x10 is escaped as 0x02, byte ^ 0x10
+'''
+
+import functools
+import operator
+import struct
+
+HEADER = struct.Struct('!HHB')  # msg_type, length, checksum
+HEADER_SIZE = HEADER.size
+
+_HIGH_BYTES = bytes(range(0x10, 0x100))
+_LOW_BYTES = [bytes((b,)) for b in range(0x10)]
+_ESCAPED = [bytes((0x02, b ^ 0x10)) for b in range(0x10)]
+_FLIP_TABLE = bytes(b ^ 0x10 for b in range(0x100))
+_FOLD_THRESHOLD = 32
+
+
+def zigate_encode(data):
+    '''
+    escape bytes lower than 0x10
+    '''
+    data = bytes(data)
+    low = data.translate(None, _HIGH_BYTES)
+    if not low:
+        return data
+    low = set(low)
+    # 0x02 must be escaped first since it prefixes every escaped byte
+    if 0x02 in low:
+        data = data.replace(b'\x02', b'\x02\x12')
+        low.discard(0x02)
+    for b in low:
+        data = data.replace(_LOW_BYTES[b], _ESCAPED[b])
+    return data
+
+
+def zigate_decode(data):
+    '''
+    unescape data
+    '''
+    data = bytes(data)
+    if b'\x02' not in data:
+        return data
+    parts = data.split(b'\x02')
+    decoded = [parts[0]]
+    for part in parts[1:]:
+        decoded.append(part[:1].translate(_FLIP_TABLE))
+        decoded.append(part[1:])
+    return b''.join(decoded)
+
+
+def _xor_bytes(data):
+    size = len(data)
+    if size < _FOLD_THRESHOLD:
+        return functools.reduce(operator.xor, data, 0)
+    # fold the upper half on the lower half until one byte remains,
+    # each fold keeps the xor of all the bytes unchanged
+    value = int.from_bytes(data, 'big')
+    while size > 1:
+        half = size // 2
+        value = (value >> (half * 8)) ^ (value & ((1 << (half * 8)) - 1))
+        size -= half
+    return value
+
+
+def checksum(*args):
+    '''
+    xor of all bytes of args
+    args could be int or bytes like
+    '''
+    chcksum = 0
+    for arg in args:
+        if isinstance(arg, int):
+            chcksum ^= arg
+        elif arg:
+            chcksum ^= _xor_bytes(arg)
+    return chcksum
+
+
+def encode_message(msg_type, data=b''):
+    '''
+    build a complete escaped frame
+    '''
+    length = len(data)
+    header = HEADER.pack(msg_type, length, 0)
+    chcksum = checksum(header, data)
+    header = HEADER.pack(msg_type, length, chcksum)
+    return b'\x01' + zigate_encode(header + data) + b'\x03'
+
+
+def decode_message(packet):
+    '''
+    unescape a complete frame
+    return msg_type, length, checksum, value, lqi
+    raise struct.error if packet is too short
+    '''
+    decoded = zigate_decode(packet[1:-1])
+    if len(decoded) < HEADER_SIZE + 1:
+        raise struct.error('Packet too short')
+    msg_type, length, chcksum = HEADER.unpack_from(decoded)
+    return msg_type, length, chcksum, decoded[HEADER_SIZE:-1], decoded[-1]
@@ -17,6 +17,15 @@ from .transport import (ThreadSerialConnection,
                         ThreadSocketConnection,
                         FakeTransport)
 from .responses import (RESPONSES, Response)
+from .codec import (zigate_encode, zigate_decode, checksum,
+                    encode_message, decode_message, HEADER)
+from .pool import ShardedWorkerPool
+from .lanes import (PriorityWindow, command_lane)
+from .scheduler import SCHEDULER
+from .catalog import TemplateCatalog
+from .journal import (Journal, atomic_write)
+from . import snapshot
+from .lazy import LazyDict
 from .const import (ACTIONS_COLOR, ACTIONS_LEVEL, ACTIONS_LOCK, ACTIONS_HUE,
                     ACTIONS_ONOFF, ACTIONS_TEMPERATURE, ACTIONS_COVER,
                     ACTIONS_THERMOSTAT, ACTIONS_IAS,
@@ -31,34 +40,37 @@ from .clusters import (Cluster, get_cluster)
 import functools
 import struct
 import threading
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import random
 from enum import Enum
 import colorsys
 import datetime
-try:
-    import RPi.GPIO as GPIO
-except Exception:
-    # Fake GPIO
-    class GPIO:
-        def fake(self, *args, **kwargs):
-            LOGGER.error('GPIO Not available')
-
-        def __getattr__(self, *args, **kwargs):
-            return self.fake
-    GPIO = GPIO()
-import usb
 
 
 LOGGER = logging.getLogger('zigate')
 
 
 AUTO_SAVE = 5 * 60  # 5 minutes
+LAZY_LOAD = True  # build devices from persistent file on first use
+JOURNAL_COMPACT_SIZE = 1024 * 1024  # compact journal into persistent file above this size
+JOURNAL_COMPACT_INTERVAL = 60 * 60  # or at least every hour
 BIND_REPORT = True  # automatically bind and report state for light
 SLEEP_INTERVAL = 0.1
+DECODE_WORKERS = 4  # number of threads handling received responses
+DISCOVER_WORKERS = 2  # number of threads running device discovery
 ACTIONS = {}
 WAIT_TIMEOUT = 5
+NETWORK_UP_TIMEOUT = 3  # max wait for network to be formed at startup
+COMMAND_WINDOW = 4  # max commands sent to ZiGate waiting for their status
+BUSY_RETRY = 3  # max retries of a command when ZiGate is busy
+BUSY_RETRY_DELAY = 0.1
 DETECT_FASTCHANGE = False  # enable fast change detection
 DELAY_FASTCHANGE = 1.0  # delay fast change for cluster 0x0006
+TEMPLATES = TemplateCatalog(os.path.join(BASE_PATH, 'templates'),
+                            lambda data: Device.from_json(data))
 
 # Device id
 ACTUATORS = [0x0009, 0x0010, 0x0051,
@@ -154,10 +166,36 @@ def dispatch_signal(signal=dispatcher.Any, sender=dispatcher.Anonymous,
         LOGGER.error(traceback.format_exc())
 
 
+class FakeGPIO(object):
+    def fake(self, *args, **kwargs):
+        LOGGER.error('GPIO Not available')
+
+    def __getattr__(self, *args, **kwargs):
+        return self.fake
+
+
+GPIO = None  # RPi.GPIO imported on first use by get_gpio()
+
+
+def get_gpio():
+    '''
+    return RPi.GPIO module, or fake GPIO if not available
+    '''
+    global GPIO
+    if GPIO is None:
+        try:
+            import RPi.GPIO as gpio
+        except Exception:
+            gpio = FakeGPIO()
+        GPIO = gpio
+    return GPIO
+
+
 def ftdi_set_bitmode(dev, bitmask):
     '''
     Set mode for ZiGate DIN module
     '''
+    import usb.util
     BITMODE_CBUS = 0x20
     SIO_SET_BITMODE_REQUEST = 0x0b
     bmRequestType = usb.util.build_request_type(usb.util.CTRL_OUT,
@@ -167,6 +205,23 @@ def ftdi_set_bitmode(dev, bitmask):
     dev.ctrl_transfer(bmRequestType, SIO_SET_BITMODE_REQUEST, wValue)
 
 
+class Command(object):
+    '''
+    Command sent to ZiGate waiting for its status
+    '''
+    def __init__(self, cmd, frame, wait_response=None, callback=None):
+        self.cmd = cmd
+        self.frame = frame
+        self.wait_response = wait_response
+        self.callback = callback
+        self.lane = command_lane(cmd)
+        self.status = concurrent.futures.Future()
+        self.response = None  # [sequence, future] waiting for wait_response
+        self.credit = None
+        self.deadline = 0
+        self.retries = BUSY_RETRY
+
+
 class ZiGate(object):
 
     def __init__(self, port='auto', path='~/.zigate.json',
@@ -175,7 +230,9 @@ class ZiGate(object):
                  channel=None,
                  adminpanel=False):
         self._model = 'TTL'  # TTL, WiFI, DIN, GPIO
-        self._devices = {}
+        self._devices = LazyDict(self._hydrate_device)
+        self._ieee_index = {}  # ieee: addr
+        self.lazy_load = LAZY_LOAD
         self._groups = {}
         self._scenes = {}
         self._led = True
@@ -183,13 +240,31 @@ class ZiGate(object):
         self._building_neighbours_table = False
         self._path = path
         self._version = None
+        self._network_state = None  # last network state response
+        self._network_up = threading.Event()
+        self._state_loaded = threading.Event()
+        self._state_loaded.set()
+        self.startup_timing = collections.OrderedDict()  # phase: duration
         self._port = port
         self._last_response = {}  # response to last command type
         self._last_status = {}  # status to last command type
+        self._pending_status = {}  # cmd: deque of Command in send order
+        self._pending_responses = {}  # msg_type: list of [sequence, future]
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._command_credits = PriorityWindow(COMMAND_WINDOW)
+        self._pipeline = threading.local()
         self._save_lock = threading.Lock()
         self._autosavetimer = None
+        self._autosave_event = threading.Event()
+        self._autosave_thread = None
+        self._journal = None
+        self._last_compaction = 0
         self._closing = False
         self.connection = None
+        self.decode_workers = DECODE_WORKERS
+        self._decode_pool = None
+        self._discover_pool = None
 
         self._addr = '0000'
         self._ieee = None
@@ -230,6 +305,7 @@ class ZiGate(object):
         if self.model != 'DIN':
             LOGGER.warning('Method only supported on ZiGate DIN')
             return
+        import usb.core
         dev = usb.core.find(idVendor=0x0403, idProduct=0x6001)
         if not dev:
             LOGGER.error('ZiGate DIN not found.')
@@ -255,6 +331,7 @@ class ZiGate(object):
         if self.model != 'DIN':
             LOGGER.warning('Method only supported on ZiGate DIN')
             return
+        import usb.core
         dev = usb.core.find(idVendor=0x0403, idProduct=0x6001)
         if not dev:
             LOGGER.error('ZiGate DIN not found.')
@@ -294,16 +371,24 @@ class ZiGate(object):
         return self.adminpanel
 
     def _event_loop(self):
+        self._state_loaded.wait()  # received packets need known devices
         while not self._closing:
-            if self.connection and not self.connection.received.empty():
-                packet = self.connection.received.get()
-                dispatch_signal(ZIGATE_PACKET_RECEIVED, self, packet=packet)
-                t = threading.Thread(target=self.decode_data, args=(packet,),
-                                     name='ZiGate-Decode data')
-                t.setDaemon(True)
-                t.start()
-            else:
+            connection = self.connection
+            if not connection:  # not yet connected
                 sleep(SLEEP_INTERVAL)
+                continue
+            packet = connection.received.get()
+            if packet is None:  # wake up from close()
+                continue
+            dispatch_signal(ZIGATE_PACKET_RECEIVED, self, packet=packet)
+            self.decode_data(packet)
+
+    def decode_metrics(self):
+        '''
+        return queue depth metrics of decode workers
+        '''
+        if self._decode_pool:
+            return self._decode_pool.metrics()
 
     def setup_connection(self):
         self.connection = ThreadSerialConnection(self, self._port)
@@ -312,13 +397,23 @@ class ZiGate(object):
         self._closing = True
         if self._autosavetimer:
             self._autosavetimer.cancel()
+        self._autosave_event.set()
         try:
             if self.connection:
+                self.connection.received.put(None)
                 self.connection.close()
         except Exception:
             LOGGER.error('Exception during closing')
             LOGGER.error(traceback.format_exc())
         self.connection = None
+        if self._decode_pool:
+            self._decode_pool.stop()
+            self._decode_pool = None
+        if self._discover_pool:
+            self._discover_pool.stop()
+            self._discover_pool = None
+        if self._journal:
+            self._journal.flush()
         self._started = False
 
     def save_state(self, path=None):
@@ -336,15 +431,22 @@ class ZiGate(object):
             LOGGER.error('Failed to acquire Lock to save persistent file')
             return
         try:
+            journal = self._open_journal()
+            journal.rotate()
             data = {'devices': list(self._devices.values()),
                     'groups': self._groups,
                     'scenes': self._scenes,
                     'neighbours_table': self._neighbours_table_cache,
                     'led': self._led
                     }
-            with open(self._path, 'w') as fp:
-                json.dump(data, fp, cls=DeviceEncoder,
-                          sort_keys=True, indent=4, separators=(',', ': '))
+            if self._path.endswith(snapshot.SNAPSHOT_EXTENSION):
+                data['devices'] = [device.to_snapshot() for device in data['devices']]
+                atomic_write(self._path, snapshot.dumps(data, DeviceEncoder().default), 'wb')
+            else:
+                atomic_write(self._path, json.dumps(data, cls=DeviceEncoder,
+                                                    sort_keys=True, separators=(',', ':')))
+            journal.discard_rotated()
+            self._last_compaction = monotonic()
         except Exception:
             LOGGER.error('Failed to save persistent file %s', self._path)
             LOGGER.error(traceback.format_exc())
@@ -358,13 +460,20 @@ class ZiGate(object):
             LOGGER.warning('Persistent file is disabled')
             return
         self._path = os.path.expanduser(path)
+        self._journal = None  # don't journal while loading
         LOGGER.debug('Trying to load %s', self._path)
         if not os.path.exists(self._path):
             LOGGER.warning('Persistent file %s doesn\'t exist', self._path)
-            return False
+            return self._replay_journal()
         try:
-            with open(self._path) as fp:
-                data = json.load(fp)
+            with open(self._path, 'rb') as fp:
+                data = fp.read()
+            if snapshot.is_snapshot(data):
+                data = snapshot.loads(data)
+                device_loader = Device.from_snapshot
+            else:
+                data = json.loads(data.decode())
+                device_loader = Device.from_json
             if not isinstance(data, dict):  # old version
                 data = {'devices': data, 'groups': {}}
             groups = data.get('groups', {})
@@ -378,33 +487,183 @@ class ZiGate(object):
             devices = data.get('devices', [])
             for data in devices:
                 try:
-                    device = Device.from_json(data, self)
+                    if self.lazy_load:
+                        info = data['info']
+                        self._devices.set_raw(info['addr'], (device_loader, data))
+                        if info.get('ieee'):
+                            self._ieee_index[info['ieee']] = info['addr']
+                        continue
+                    device = device_loader(data, self)
                     self._devices[device.addr] = device
+                    self._index_device(device)
                     device._create_actions()
                 except Exception:
                     LOGGER.error('Error loading device %s', data)
             LOGGER.debug('Load success')
+            self._replay_journal()
+            if self._devices.raw_count():
+                t = threading.Thread(target=self._warm_up_devices, name='ZiGate-Warm up')
+                t.setDaemon(True)
+                t.start()
             return True
         except Exception:
             LOGGER.error('Failed to load persistent file %s', self._path)
             LOGGER.error(traceback.format_exc())
         LOGGER.debug('No file to load')
+        self._replay_journal()
         return False
 
+    def _hydrate_device(self, raw):
+        '''
+        build device kept as raw data by lazy load_state
+        '''
+        device_loader, data = raw
+        try:
+            device = device_loader(data, self)
+            device._create_actions()
+        except Exception:
+            LOGGER.error('Error loading device %s', data)
+            LOGGER.error(traceback.format_exc())
+            raise
+        return device
+
+    def _warm_up_devices(self):
+        '''
+        build remaining lazy loaded devices in background
+        '''
+        t1 = monotonic()
+        count = 0
+        while not self._closing and self._devices.load_next():
+            count += 1
+            sleep(0)  # let other threads run
+        LOGGER.debug('%s devices warmed up in %.3fs', count, monotonic() - t1)
+
+    def _open_journal(self):
+        '''
+        return journal of persistent file, create it if needed
+        '''
+        path = self._path + '.journal'
+        if self._journal is None or self._journal.path != path:
+            if self._journal:
+                self._journal.flush()
+            self._journal = Journal(path, DeviceEncoder)
+        return self._journal
+
+    def _replay_journal(self):
+        '''
+        apply changes journaled since last save_state,
+        return True if at least one change was applied
+        '''
+        journal = self._open_journal()
+        count = 0
+        for record in journal.records():
+            try:
+                self._apply_journal_record(record)
+                count += 1
+            except Exception:
+                LOGGER.error('Error replaying journal record %s', record)
+                LOGGER.error(traceback.format_exc())
+        if count:
+            LOGGER.debug('%s journal records replayed', count)
+        return count > 0
+
+    def _apply_journal_record(self, record):
+        kind = record['type']
+        if kind == 'attribute':
+            device = self._devices.get(record['addr'])
+            if device:
+                device.info.update(record['info'])
+                cluster = device.get_cluster(record['endpoint'], record['cluster'])
+                attribute = record['attribute']
+                if cluster.update(attribute):
+                    device._claim_name(record['endpoint'], record['cluster'],
+                                       cluster.get_attribute(attribute['attribute']))
+        elif kind == 'device':
+            device = Device.from_json(record['device'], self)
+            self._devices[device.addr] = device
+            self._index_device(device)
+            device._create_actions()
+        elif kind == 'remove':
+            device = self._devices.pop(record['addr'], None)
+            ieee = device and device.info.get('ieee')
+            if ieee and self._ieee_index.get(ieee) == record['addr']:
+                del self._ieee_index[ieee]
+        elif kind == 'groups':
+            self._groups = {k: set([tuple(r) for r in v]) for k, v in record['groups'].items()}
+        elif kind == 'neighbours_table':
+            self._neighbours_table_cache = record['neighbours_table']
+        elif kind == 'led':
+            self._led = record['led']
+
+    def _journal_record(self, key, record):
+        if self._journal:
+            self._journal.append(key, record)
+
+    def _journal_device(self, device):
+        self._journal_record(('device', device.addr), {'type': 'device', 'device': device})
+
+    def _journal_remove(self, addr):
+        self._journal_record(('device', addr), {'type': 'remove', 'addr': addr})
+
+    def _journal_attribute(self, device, endpoint_id, cluster_id, attribute):
+        self._journal_record(('attribute', device.addr, endpoint_id, cluster_id, attribute['attribute']),
+                             {'type': 'attribute',
+                              'addr': device.addr,
+                              'endpoint': endpoint_id,
+                              'cluster': cluster_id,
+                              'attribute': dict(attribute),
+                              'info': dict(device.info)})
+
+    def _journal_groups(self):
+        self._journal_record('groups', {'type': 'groups',
+                                        'groups': {k: list(v) for k, v in self._groups.items()}})
+
     def start_auto_save(self):
+        '''
+        trigger auto save every AUTO_SAVE seconds,
+        it runs on its own thread so a slow disk or zigate never holds a scheduler worker
+        '''
+        self._autosavetimer = SCHEDULER.schedule(AUTO_SAVE, self.start_auto_save)
+        thread = self._autosave_thread
+        if thread is None or not thread.is_alive():
+            thread = self._autosave_thread = threading.Thread(target=self._auto_save_loop,
+                                                              name='ZiGate-Auto save')
+            thread.setDaemon(True)
+            thread.start()
+        self._autosave_event.set()
+
+    def _auto_save_loop(self):
+        while True:
+            self._autosave_event.wait()
+            self._autosave_event.clear()
+            if self._closing:
+                break
+            try:
+                self._auto_save()
+            except Exception:
+                LOGGER.error('Auto save failed')
+                LOGGER.error(traceback.format_exc())
+
+    def _auto_save(self):
         LOGGER.debug('Auto saving %s', self._path)
-        self.save_state()
-        self._autosavetimer = threading.Timer(AUTO_SAVE, self.start_auto_save)
-        self._autosavetimer.setDaemon(True)
-        self._autosavetimer.start()
+        journal = self._journal
+        if journal is None or journal.size() > JOURNAL_COMPACT_SIZE or \
+           monotonic() - self._last_compaction > JOURNAL_COMPACT_INTERVAL:
+            self.save_state()
+        else:
+            journal.flush()
         # check if we're still connected to zigate
-        if self.send_data(0x0010) is None:
+        if self.send_data(0x0010) is None and self.connection:
             self.connection.reconnect()
 
     def __del__(self):
         self.close()
 
     def _start_event_thread(self):
+        self._decode_pool = ShardedWorkerPool(self.decode_workers, 'ZiGate-Decode')
+        self._decode_pool.start()
+        self._discover_pool = ShardedWorkerPool(DISCOVER_WORKERS, 'ZiGate-Discover')
+        self._discover_pool.start()
         self._event_thread = threading.Thread(target=self._event_loop,
                                               name='ZiGate-Event Loop')
         self._event_thread.setDaemon(True)
@@ -416,59 +675,110 @@ class ZiGate(object):
     def startup(self, channel=None):
         '''
         Startup sequence:
-            - Load persistent file
-            - setup connection
-            - Set Channel mask
-            - Set Type Coordinator
-            - Start Network
+            - Load persistent file while setting up connection
+            - Set led, Channel mask, Type Coordinator
+              and get version and network state in one pipeline
+            - Start Network if needed
+            - Set raw mode and time
             - Refresh devices list
+        duration of each phase is stored in startup_timing
         '''
         if self._started:
             return
+        t1 = monotonic()
+        self.startup_timing.clear()
         self._closing = False
+        self._state_loaded.clear()
         self._start_event_thread()
-        self.load_state()
-        self.setup_connection()
-        self.set_led(self._led)
-        version = self.get_version()
-        self.set_channel(channel)
-        self.set_type(TYPE_COORDINATOR)
+        loader = threading.Thread(target=self._startup_load_state, name='ZiGate-Load state')
+        loader.setDaemon(True)
+        loader.start()
+        with self._startup_phase('connection'):
+            self.setup_connection()
+        loader.join()
+        with self._startup_phase('configure'):
+            self._network_state = None
+            with self.pipeline():
+                self.set_led(self._led)
+                self.get_version()
+                self.set_channel(channel)
+                self.set_type(TYPE_COORDINATOR)
+                self.get_network_state()
+        version = self._version
+        network_state = self._network_state
         LOGGER.debug('Check network state')
-        # self.start_network()
-        network_state = self.get_network_state()
-        if not network_state:
-            LOGGER.error('Failed to get network state')
-        if not network_state or network_state.get('extended_panid') == 0 or \
-           network_state.get('addr') == 'ffff':
+        if not self._is_network_up(network_state):
             LOGGER.debug('Network is down, start it')
-            self.start_network(True)
-            tries = 3
-            while tries > 0:
-                sleep(1)
-                tries -= 1
-                network_state = self.get_network_state()
-                if network_state and \
-                   network_state.get('extended_panid') != 0 and \
-                   network_state.get('addr') != 'ffff':
-                    break
-            if tries <= 0:
+            with self._startup_phase('network'):
+                self._network_up.clear()
+                self.start_network(True)
+                network_state = self._wait_network_up()
+            if not network_state:
                 LOGGER.error('Failed to start network')
                 self.reset()
                 return
 
-        if version and version['version'] >= '3.1a':
-            LOGGER.debug('Set Zigate normal mode (firmware >= 3.1a)')
-            self.set_raw_mode(False)
-
-        if version and version['version'] >= '3.0f':
-            LOGGER.debug('Set Zigate Time (firmware >= 3.0f)')
-            self.set_time()
-        self.get_devices_list(True)
+        with self._startup_phase('firmware'):
+            with self.pipeline():
+                if version and version['version'] >= '3.1a':
+                    LOGGER.debug('Set Zigate normal mode (firmware >= 3.1a)')
+                    self.set_raw_mode(False)
+
+                if version and version['version'] >= '3.0f':
+                    LOGGER.debug('Set Zigate Time (firmware >= 3.0f)')
+                    self.set_time()
+        with self._startup_phase('devices_list'):
+            self.get_devices_list(True)
+        self.startup_timing['total'] = monotonic() - t1
+        LOGGER.info('Startup done in %.3fs (%s)', self.startup_timing['total'],
+                    ', '.join('{} {:.3f}s'.format(k, v) for k, v in self.startup_timing.items()
+                              if k != 'total'))
         t = threading.Thread(target=self.need_discovery)
         t.setDaemon(True)
         t.start()
 #         self.need_discovery()
 
+    @contextlib.contextmanager
+    def _startup_phase(self, name):
+        t1 = monotonic()
+        try:
+            yield
+        finally:
+            self.startup_timing[name] = monotonic() - t1
+
+    def _startup_load_state(self):
+        try:
+            with self._startup_phase('load_state'):
+                self.load_state()
+        finally:
+            self._state_loaded.set()
+
+    def startup_metrics(self):
+        '''
+        return duration of each phase of last startup
+        '''
+        return dict(self.startup_timing)
+
+    def _is_network_up(self, network_state):
+        return bool(network_state) and \
+            network_state.get('extended_panid') != 0 and \
+            network_state.get('addr') != 'ffff'
+
+    def _wait_network_up(self, timeout=NETWORK_UP_TIMEOUT):
+        '''
+        wait for network joined / formed response,
+        return network state or None after timeout
+        '''
+        deadline = monotonic() + timeout
+        while True:
+            self._network_up.wait(max(0, deadline - monotonic()))
+            self._network_up.clear()
+            network_state = self.get_network_state()
+            if self._is_network_up(network_state):
+                return network_state
+            if monotonic() >= deadline:
+                return
+
     def need_discovery(self):
         '''
         scan device which need discovery
@@ -486,36 +796,13 @@ class ZiGate(object):
                                              'device': device})
 
     def zigate_encode(self, data):
-        encoded = bytearray()
-        for b in data:
-            if b < 0x10:
-                encoded.extend([0x02, 0x10 ^ b])
-            else:
-                encoded.append(b)
-        return encoded
+        return bytearray(zigate_encode(data))
 
     def zigate_decode(self, data):
-        flip = False
-        decoded = bytearray()
-        for b in data:
-            if flip:
-                flip = False
-                decoded.append(b ^ 0x10)
-            elif b == 0x02:
-                flip = True
-            else:
-                decoded.append(b)
-        return decoded
+        return bytearray(zigate_decode(data))
 
     def checksum(self, *args):
-        chcksum = 0
-        for arg in args:
-            if isinstance(arg, int):
-                chcksum ^= arg
-                continue
-            for x in arg:
-                chcksum ^= x
-        return chcksum
+        return checksum(*args)
 
     def send_to_transport(self, data):
         if not self.connection or not self.connection.is_connected():
@@ -523,14 +810,57 @@ class ZiGate(object):
             return
         self.connection.send(data)
 
-    def send_data(self, cmd, data="", wait_response=None, wait_status=True):
+    def set_command_window(self, size):
+        '''
+        set max number of commands sent waiting for their status
+        '''
+        self._command_credits.resize(max(1, size))
+
+    def command_metrics(self):
+        '''
+        return queue depth and wait time of outgoing commands per priority lane
+        '''
+        return self._command_credits.metrics()
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        '''
+        send_data in this block doesn't wait for status and response and returns None,
+        they are all waited when leaving the block
+        '''
+        if getattr(self._pipeline, 'commands', None) is not None:  # nested
+            yield
+            return
+        self._pipeline.commands = []
+        try:
+            yield
+        finally:
+            commands = self._pipeline.commands
+            self._pipeline.commands = None
+            for command in commands:
+                self._wait_command(command)
+
+    def send_data(self, cmd, data="", wait_response=None, wait_status=True, callback=None):
         '''
         send data through ZiGate
+        callback is called with the result (status or response) before returning it
         '''
         LOGGER.debug('REQUEST : 0x{:04x} {}'.format(cmd, data))
-        self._last_status[cmd] = None
-        if wait_response:
-            self._clear_response(wait_response)
+        if not wait_status:
+            wait_response = None
+        command = self._send_command(cmd, data, wait_response, callback)
+        if not wait_status:
+            return False
+        commands = getattr(self._pipeline, 'commands', None)
+        if commands is not None:
+            commands.append(command)
+            return
+        return self._wait_command(command)
+
+    def _send_command(self, cmd, data="", wait_response=None, callback=None):
+        '''
+        send command without waiting for its status
+        '''
         if isinstance(cmd, int):
             byte_cmd = struct.pack('!H', cmd)
         elif isinstance(data, str):
@@ -543,45 +873,54 @@ class ZiGate(object):
             byte_data = data
         assert type(byte_cmd) == bytes
         assert type(byte_data) == bytes
-        length = len(byte_data)
-        byte_length = struct.pack('!H', length)
-        checksum = self.checksum(byte_cmd, byte_length, byte_data)
-
-        msg = struct.pack('!HHB%ds' % length, cmd, length, checksum, byte_data)
-        LOGGER.debug('Msg to send %s', hexlify(msg))
-
-        enc_msg = self.zigate_encode(msg)
-        enc_msg.insert(0, 0x01)
-        enc_msg.append(0x03)
-        encoded_output = bytes(enc_msg)
-        LOGGER.debug('Encoded Msg to send %s', hexlify(encoded_output))
-
-        self.send_to_transport(encoded_output)
-        if wait_status:
-            status = self._wait_status(cmd)
-            if wait_response and status is not None:
-                r = self._wait_response(wait_response)
-                return r
-            return status
-        return False
+        cmd = struct.unpack('!H', byte_cmd)[0]
+        command = Command(cmd, encode_message(cmd, byte_data), wait_response, callback)
+        LOGGER.debug('Encoded Msg to send %s', hexlify(command.frame))
+
+        command.credit = self._acquire_credit(command.lane)
+        with self._send_lock:
+            if wait_response:
+                command.response = self._expect_response(wait_response)
+            self._push_command(command)
+            self.send_to_transport(command.frame)
+        return command
+
+    def _resend_command(self, command):
+        with self._send_lock:
+            if command.status.done():  # caller gave up waiting
+                return
+            self._push_command(command)
+            self.send_to_transport(command.frame)
+
+    def _wait_command(self, command):
+        '''
+        wait for status, then for response of command if needed
+        '''
+        r = self._wait_status(command.cmd, command)
+        if command.response:
+            if r is not None:
+                r = self._wait_response(command.wait_response, command.response)
+            else:
+                self._cancel_response(command.wait_response, command.response)
+        if command.callback:
+            r = command.callback(r)
+        return r
 
     def decode_data(self, packet):
         '''
         Decode raw packet message
         '''
         try:
-            decoded = self.zigate_decode(packet[1:-1])
-            msg_type, length, checksum, value, lqi = \
-                struct.unpack('!HHB%dsB' % (len(decoded) - 6), decoded)
+            msg_type, length, received_checksum, value, lqi = decode_message(packet)
         except Exception:
             LOGGER.error('Failed to decode packet : %s', hexlify(packet))
             return
         if length != len(value) + 1:  # add lqi length
             LOGGER.error('Bad length %s != %s : %s', length, len(value) + 1, value)
             return
-        computed_checksum = self.checksum(decoded[:4], lqi, value)
-        if checksum != computed_checksum:
-            LOGGER.error('Bad checksum %s != %s', checksum, computed_checksum)
+        computed_checksum = checksum(HEADER.pack(msg_type, length, 0), lqi, value)
+        if received_checksum != computed_checksum:
+            LOGGER.error('Bad checksum %s != %s', received_checksum, computed_checksum)
             return
         LOGGER.debug('Received response 0x{:04x}: {}'.format(msg_type, hexlify(value)))
         try:
@@ -593,7 +932,20 @@ class ZiGate(object):
         if msg_type != response.msg:
             LOGGER.warning('Unknown response 0x{:04x}'.format(msg_type))
         LOGGER.debug(response)
+        # status and responses are resolved at once, a worker may be waiting for them
+        if response.msg == 0x8000:
+            self._last_status[response['packet_type']] = response
+            self._resolve_status(response)
         self._last_response[msg_type] = response
+        self._resolve_response(msg_type, response)
+        pool = self._decode_pool
+        if pool and pool.running:
+            # responses of the same device are handled in order by the same worker
+            pool.submit(response.get('addr'), self._handle_response, response)
+        else:
+            self._handle_response(response)
+
+    def _handle_response(self, response):
         self.interpret_response(response)
         dispatch_signal(ZIGATE_RESPONSE_RECEIVED, self, response=response)
 
@@ -603,7 +955,6 @@ class ZiGate(object):
                 LOGGER.error('Command 0x{:04x} failed {} : {}'.format(response['packet_type'],
                                                                       response.status_text(),
                                                                       response['error']))
-            self._last_status[response['packet_type']] = response
         elif response.msg == 0x8011:  # APS_DATA_ACK
             if response['status'] != 0:
                 LOGGER.error('Device {} doesn\'t receive last command to '
@@ -611,9 +962,13 @@ class ZiGate(object):
                                                                        response['endpoint'],
                                                                        response['cluster'],
                                                                        response['status']))
+        elif response.msg == 0x8024:  # network joined / formed
+            if response['status'] < 2:
+                self._network_up.set()
         elif response.msg == 0x8007:  # factory reset
             if response['status'] == 0:
-                self._devices = {}
+                self._devices = LazyDict(self._hydrate_device)
+                self._ieee_index = {}
                 self.start_network()
         elif response.msg == 0x8015:  # device list
             keys = set(self._devices.keys())
@@ -634,7 +989,7 @@ class ZiGate(object):
             d = self.get_device_from_addr(addr)
             if d:
                 d.update_info(response.cleaned_data())
-                self.discover_device(addr)
+                self._discover_later(addr)
         elif response.msg == 0x8043:  # simple descriptor
             addr = response['addr']
             endpoint = response['endpoint']
@@ -644,8 +999,7 @@ class ZiGate(object):
                 ep.update(response.cleaned_data())
                 ep['in_clusters'] = response['in_clusters']
                 ep['out_clusters'] = response['out_clusters']
-                self.discover_device(addr)
-                d._create_actions()
+                self._discover_later(addr, d._create_actions)
         elif response.msg == 0x8045:  # endpoint list
             addr = response['addr']
             d = self.get_device_from_addr(addr)
@@ -653,7 +1007,7 @@ class ZiGate(object):
                 for endpoint in response['endpoints']:
                     ep = d.get_endpoint(endpoint['endpoint'])
                     self.simple_descriptor_request(addr, endpoint['endpoint'])
-                self.discover_device(addr)
+                self._discover_later(addr)
         elif response.msg == 0x8048:  # leave
             device = self.get_device_from_ieee(response['ieee'])
             if device:
@@ -768,6 +1122,10 @@ class ZiGate(object):
         remove device from addr
         '''
         device = self._devices.pop(addr)
+        ieee = device.info.get('ieee')
+        if ieee and self._ieee_index.get(ieee) == addr:
+            del self._ieee_index[ieee]
+        self._journal_remove(addr)
         dispatch_signal(ZIGATE_DEVICE_REMOVED, **{'zigate': self,
                                                   'addr': addr,
                                                   'device': device})
@@ -779,6 +1137,8 @@ class ZiGate(object):
         assert type(device) == Device
         if device.addr in self._devices:
             self._devices[device.addr].update(device)
+            self._index_device(self._devices[device.addr])
+            self._journal_device(self._devices[device.addr])
             dispatch_signal(ZIGATE_DEVICE_UPDATED, self, **{'zigate': self,
                                                             'device': self._devices[device.addr]})
         else:
@@ -792,6 +1152,9 @@ class ZiGate(object):
                 d.update(device)
                 self._devices[new_addr] = d
                 del self._devices[old_addr]
+                self._index_device(d)
+                self._journal_remove(old_addr)
+                self._journal_device(d)
                 dispatch_signal(ZIGATE_DEVICE_ADDRESS_CHANGED, self,
                                 **{'zigate': self,
                                    'device': d,
@@ -800,49 +1163,166 @@ class ZiGate(object):
                                    })
             else:
                 self._devices[device.addr] = device
+                self._index_device(device)
+                self._journal_device(device)
                 dispatch_signal(ZIGATE_DEVICE_ADDED, self, **{'zigate': self,
                                                               'device': device})
-            self.discover_device(device.addr)
+            self._discover_later(device.addr)
 
     def get_status_text(self, status_code):
         return STATUS_CODES.get(status_code,
                                 'Failed with event code: %s', status_code)
 
-    def _clear_response(self, msg_type):
-        if msg_type in self._last_response:
-            del self._last_response[msg_type]
+    def _acquire_credit(self, lane):
+        '''
+        wait for a free place in the window of commands waiting for their status,
+        commands of higher priority lanes are served first
+        '''
+        credits = self._command_credits
+        if not credits.acquire(lane, WAIT_TIMEOUT, SLEEP_INTERVAL, self._expire_commands):
+            LOGGER.warning('Too many commands waiting for status, send anyway')
+            return
+        return credits
 
-    def _wait_response(self, msg_type):
+    def _release_credit(self, command):
         '''
-        wait for next msg_type response
+        give back command credit, must be called with _pending_lock
         '''
-        LOGGER.debug('Waiting for message 0x{:04x}'.format(msg_type))
-        t1 = monotonic()
-        while self._last_response.get(msg_type) is None:
-            sleep(0.01)
-            t2 = monotonic()
-            if t2 - t1 > WAIT_TIMEOUT:  # no response timeout
-                LOGGER.warning('No response waiting command 0x{:04x}'.format(msg_type))
+        if command.credit:
+            command.credit.release()
+            command.credit = None
+
+    def _push_command(self, command):
+        '''
+        register command waiting for its status, must be called in send order
+        '''
+        command.deadline = monotonic() + WAIT_TIMEOUT
+        with self._pending_lock:
+            pending = self._pending_status.setdefault(command.cmd, collections.deque())
+            pending.append(command)
+
+    def _drop_command(self, command):
+        with self._pending_lock:
+            command.status.cancel()
+            pending = self._pending_status.get(command.cmd)
+            if pending and command in pending:
+                pending.remove(command)
+            self._release_credit(command)
+
+    def _expire_commands(self):
+        '''
+        drop commands which never got their status
+        '''
+        now = monotonic()
+        with self._pending_lock:
+            for pending in self._pending_status.values():
+                while pending and (pending[0].status.done() or pending[0].deadline < now):
+                    command = pending.popleft()
+                    command.status.cancel()
+                    self._release_credit(command)
+
+    def _resolve_status(self, status):
+        '''
+        complete the oldest pending command matching the status
+        '''
+        now = monotonic()
+        with self._pending_lock:
+            pending = self._pending_status.get(status['packet_type'])
+            while pending:
+                command = pending.popleft()
+                if command.status.done() or command.deadline < now:  # nobody waits for it anymore
+                    command.status.cancel()
+                    self._release_credit(command)
+                    continue
+                if status['status'] == 4 and command.retries > 0:  # busy, keep credit and retry
+                    command.retries -= 1
+                    LOGGER.debug('ZiGate busy, retry command 0x{:04x}'.format(command.cmd))
+                    SCHEDULER.schedule(BUSY_RETRY_DELAY, self._resend_command, command)
+                    break
+                self._release_credit(command)
+                if command.response:
+                    command.response[0] = status.get('sequence')
+                command.status.set_result(status)
+                break
+
+    def _expect_response(self, msg_type):
+        '''
+        register a waiter for next msg_type response
+        '''
+        waiter = [None, concurrent.futures.Future()]
+        with self._pending_lock:
+            self._pending_responses.setdefault(msg_type, []).append(waiter)
+        return waiter
+
+    def _cancel_response(self, msg_type, waiter):
+        with self._pending_lock:
+            waiter[1].cancel()
+            waiters = self._pending_responses.get(msg_type, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+    def _resolve_response(self, msg_type, response):
+        '''
+        complete the waiter of the response, matching the status sequence
+        if the response carries one, else the oldest waiter
+        '''
+        with self._pending_lock:
+            waiters = self._pending_responses.get(msg_type)
+            if not waiters:
+                return
+            waiters[:] = [w for w in waiters if not w[1].done()]
+            if not waiters:
                 return
+            sequence = response.get('sequence')
+            waiter = waiters[0]
+            if sequence is not None:
+                for w in waiters:
+                    if w[0] == sequence:
+                        waiter = w
+                        break
+            waiters.remove(waiter)
+            waiter[1].set_result(response)
+
+    def _wait_future(self, future):
+        '''
+        return future result or None after WAIT_TIMEOUT
+        '''
+        try:
+            return future.result(WAIT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            pass
+        with self._pending_lock:
+            if future.cancel():
+                return
+        return future.result()
+
+    def _wait_response(self, msg_type, waiter):
+        '''
+        wait for msg_type response
+        '''
+        LOGGER.debug('Waiting for message 0x{:04x}'.format(msg_type))
+        r = self._wait_future(waiter[1])
+        if r is None:
+            self._cancel_response(msg_type, waiter)
+            LOGGER.warning('No response waiting command 0x{:04x}'.format(msg_type))
+            return
         LOGGER.debug('Stop waiting, got message 0x{:04x}'.format(msg_type))
-        return self._last_response.get(msg_type)
+        return r
 
-    def _wait_status(self, cmd):
+    def _wait_status(self, cmd, command):
         '''
         wait for status of cmd
         '''
         LOGGER.debug('Waiting for status message for command 0x{:04x}'.format(cmd))
-        t1 = monotonic()
-        while self._last_status.get(cmd) is None:
-            sleep(0.01)
-            t2 = monotonic()
-            if t2 - t1 > WAIT_TIMEOUT:  # no response timeout
-                self._no_response_count += 1
-                LOGGER.warning('No response after command 0x{:04x} ({})'.format(cmd, self._no_response_count))
-                return
+        status = self._wait_future(command.status)
+        if status is None:
+            self._drop_command(command)
+            self._no_response_count += 1
+            LOGGER.warning('No response after command 0x{:04x} ({})'.format(cmd, self._no_response_count))
+            return
         self._no_response_count = 0
-        LOGGER.debug('STATUS code to command 0x{:04x}:{}'.format(cmd, self._last_status.get(cmd)))
-        return self._last_status.get(cmd)
+        LOGGER.debug('STATUS code to command 0x{:04x}:{}'.format(cmd, status))
+        return status
 
     def __addr(self, addr):
         ''' convert hex string addr to int '''
@@ -863,9 +1343,24 @@ class ZiGate(object):
 
     def get_device_from_ieee(self, ieee):
         if ieee:
-            for d in self._devices.values():
-                if d.ieee == ieee:
-                    return d
+            d = self._devices.get(self._ieee_index.get(ieee))
+            if d and d.info.get('ieee') != ieee:  # ieee changed outside of registry
+                self._reindex_devices()
+                d = self._devices.get(self._ieee_index.get(ieee))
+            return d
+
+    def _index_device(self, device):
+        '''
+        add device to ieee index
+        '''
+        ieee = device.info.get('ieee')
+        if ieee:
+            self._ieee_index[ieee] = device.addr
+
+    def _reindex_devices(self):
+        self._ieee_index = {}
+        for device in self._devices.values():
+            self._index_device(device)
 
     def get_devices_list(self, wait=False):
         '''
@@ -888,13 +1383,16 @@ class ZiGate(object):
         get zigate firmware version
         '''
         if not self._version or refresh:
-            r = self.send_data(0x0010, wait_response=0x8010)
-            if r:
-                self._version = r.data
-            else:
-                LOGGER.warning('Failed to retrieve zigate firmware version')
+            self.send_data(0x0010, wait_response=0x8010, callback=self._set_version)
         return self._version
 
+    def _set_version(self, r):
+        if r:
+            self._version = r.data
+        else:
+            LOGGER.warning('Failed to retrieve zigate firmware version')
+        return r
+
     def get_version_text(self, refresh=False):
         '''
         get zigate firmware version as text
@@ -957,6 +1455,7 @@ class ZiGate(object):
         Set Blue Led state ON/OFF
         '''
         self._led = on
+        self._journal_record('led', {'type': 'led', 'led': on})
         data = struct.pack('!?', on)
         return self.send_data(0x0018, data)
 
@@ -1008,7 +1507,9 @@ class ZiGate(object):
 
     def get_network_state(self):
         ''' get network state '''
-        r = self.send_data(0x0009, wait_response=0x8009)
+        return self.send_data(0x0009, wait_response=0x8009, callback=self._set_network_state)
+
+    def _set_network_state(self, r):
         if r:
             data = r.cleaned_data()
             self._addr = data['addr']
@@ -1016,6 +1517,7 @@ class ZiGate(object):
             self.panid = data['panid']
             self.extended_panid = data['extended_panid']
             self.channel = data['channel']
+            self._network_state = data
             return data
 
     def start_network(self, wait=False):
@@ -1094,9 +1596,9 @@ class ZiGate(object):
         '''
         retrieve short addr from ieee
         '''
-        for d in self._devices.values():
-            if d.ieee == ieee:
-                return d.addr
+        d = self.get_device_from_ieee(ieee)
+        if d:
+            return d.addr
         LOGGER.error('Failed to retrieve short address for %s', ieee)
 
     def _bind_unbind(self, cmd, ieee, endpoint, cluster,
@@ -1235,6 +1737,9 @@ class ZiGate(object):
                 self._building_neighbours_table = True
                 try:
                     self._neighbours_table_cache = self._neighbours_table()
+                    self._journal_record('neighbours_table',
+                                         {'type': 'neighbours_table',
+                                          'neighbours_table': self._neighbours_table_cache})
                 finally:
                     self._building_neighbours_table = False
             else:
@@ -1334,6 +1839,22 @@ class ZiGate(object):
             return
         device.refresh_device(full)
 
+    def _discover_later(self, addr, callback=None):
+        '''
+        run discover_device then callback on the discover workers,
+        discovery waits for responses handled by the decode workers
+        '''
+        pool = self._discover_pool
+        if pool and pool.running:
+            pool.submit(addr, self._discover_task, addr, callback)
+        else:
+            self._discover_task(addr, callback)
+
+    def _discover_task(self, addr, callback=None):
+        self.discover_device(addr)
+        if callback:
+            callback()
+
     def discover_device(self, addr, force=False):
         '''
         starts discovery process
@@ -1424,6 +1945,7 @@ class ZiGate(object):
         if group not in self._groups:
             self._groups[group] = set()
         self._groups[group].add((addr, endpoint))
+        self._journal_groups()
 
     def __remove_group(self, group, addr, endpoint):
         '''
@@ -1440,6 +1962,7 @@ class ZiGate(object):
                 self._groups[group].remove((addr, endpoint))
             if group in self._groups and len(self._groups[group]) == 0:
                 del self._groups[group]
+        self._journal_groups()
 
     def _sync_group_membership(self, addr, endpoint, groups):
         for group in groups:
@@ -1666,14 +2189,15 @@ class ZiGate(object):
             attributes = [attributes]
         length = len(attributes)
         manufacturer_specific = manufacturer_code != 0
-        for i in range(0, length, 10):
-            sub_attributes = attributes[i: i + 10]
-            sub_length = len(sub_attributes)
-            data = struct.pack('!B' + addr_fmt + 'BBHBBHB{}H'.format(sub_length), addr_mode, addr, 1,
-                               endpoint, cluster,
-                               direction, manufacturer_specific,
-                               manufacturer_code, sub_length, *sub_attributes)
-            self.send_data(0x0100, data)
+        with self.pipeline():
+            for i in range(0, length, 10):
+                sub_attributes = attributes[i: i + 10]
+                sub_length = len(sub_attributes)
+                data = struct.pack('!B' + addr_fmt + 'BBHBBHB{}H'.format(sub_length), addr_mode, addr, 1,
+                                   endpoint, cluster,
+                                   direction, manufacturer_specific,
+                                   manufacturer_code, sub_length, *sub_attributes)
+                self.send_data(0x0100, data)
 
     def write_attribute_request(self, addr, endpoint, cluster, attributes,
                                 direction=0, manufacturer_code=0):
@@ -1734,7 +2258,9 @@ class ZiGate(object):
         data = struct.pack('!B' + addr_fmt + 'BBHBBHB{}'.format(fmt), addr_mode, addr, 1, endpoint, cluster,
                            direction, manufacturer_specific,
                            manufacturer_code, length, *attributes_data)
-        r = self.send_data(0x0120, data, 0x8120)
+        return self.send_data(0x0120, data, 0x8120, callback=self._reporting_response)
+
+    def _reporting_response(self, r):
         # reporting not supported on cluster 6, supposed on/off attribute
         if r and r.status == 0x8c and r.cluster == 6:
             device = self._devices[r.addr]
@@ -2419,6 +2945,7 @@ class FakeZiGate(ZiGate):
         device.set_attribute(1, 0, {'attribute': 5, 'lqi': 170, 'data': 'lumi.weather'})
         device.load_template()
         self._devices['abcd'] = device
+        self._index_device(device)
         self._neighbours_table_cache = [['0000', 'abcd', 255]]
 
     def startup(self, channel=None):
@@ -2435,6 +2962,7 @@ class ZiGateGPIO(ZiGate):
                  auto_save=True,
                  channel=None,
                  adminpanel=False):
+        GPIO = get_gpio()
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(27, GPIO.OUT)  # GPIO2
         self.set_running_mode()
@@ -2443,6 +2971,7 @@ class ZiGateGPIO(ZiGate):
         self._model = 'GPIO'
 
     def set_running_mode(self):
+        GPIO = get_gpio()
         GPIO.output(27, GPIO.HIGH)  # GPIO2
         GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)  # GPIO0
         sleep(0.5)
@@ -2450,6 +2979,7 @@ class ZiGateGPIO(ZiGate):
         sleep(0.5)
 
     def set_bootloader_mode(self):
+        GPIO = get_gpio()
         GPIO.output(27, GPIO.LOW)  # GPIO2
         GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)  # GPIO0
         sleep(0.5)
@@ -2463,6 +2993,7 @@ class ZiGateGPIO(ZiGate):
         self.set_running_mode()
 
     def __del__(self):
+        GPIO = get_gpio()
         GPIO.cleanup()
         ZiGate.__del__(self)
 
@@ -2519,6 +3050,7 @@ class Device(object):
         self._lock = threading.Lock()
         self.info = info or {}
         self.endpoints = {}
+        self._property_index = {}  # name: (endpoint_id, cluster_id, attribute_id)
         self._expire_timer = {}
         self._fast_change = {}
         self.missing = False
@@ -2611,118 +3143,119 @@ class Device(object):
         else:
             endpoints_list = list(self.endpoints.items())
         LOGGER.debug('Start automagic bind and report process for device %s', self)
-        for endpoint_id, endpoint in endpoints_list:
-            # if endpoint['device'] in ACTUATORS:  # light
-            LOGGER.debug('Bind and report endpoint %s for device %s', endpoint_id, self)
-#             if 0x0001 in endpoint['in_clusters']:
-#                 LOGGER.debug('bind and report for cluster 0x0001')
-#                 self._zigate.bind_addr(self.addr, endpoint_id, 0x0001)
-#                 self._zigate.reporting_request(self.addr, endpoint_id,
-#                                                0x0001, (0x0020, 0x20))
-#                 self._zigate.reporting_request(self.addr, endpoint_id,
-#                                                0x0001, (0x0021, 0x20))
-            if 0x0006 in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x0006')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0006)
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0006, (0x0000, 0x10))
-            if 0x0008 in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x0008')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0008)
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0008, (0x0000, 0x20))
-            if 0x000f in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x000f')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x000f)
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x000f, (0x0055, 0x10))
-            if 0x0102 in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x0102')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0102)
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0102, (0x0007, 0x20))
-            if 0x0201 in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x0201')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0201)
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x0000, 0x29))
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x0002, 0x18))
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x0008, 0x20))
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x0012, 0x29))
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x0014, 0x29))
-                self._zigate.reporting_request(self.addr, endpoint_id,
-                                               0x0201, (0x001C, 0x30))
-            if 0x0300 in endpoint['in_clusters']:
-                LOGGER.debug('bind and report for cluster 0x0300')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0300)
-                if endpoint['device'] in (0x0105,):
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0000, 0x20))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0001, 0x20))
-                elif endpoint['device'] in (0x010D, 0x0210):
-                    # self._zigate.reporting_request(self.addr,
-                    #                               endpoint_id,
-                    #                               0x0300, [(0x0000, 0x20),
-                    #                                        (0x0001, 0x20),
-                    #                                        (0x0003, 0x21),
-                    #                                        (0x0004, 0x21),
-                    #                                        (0x0007, 0x21),
-                    #                                        ])
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0000, 0x20))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0001, 0x20))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0003, 0x21))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0004, 0x21))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0007, 0x21))
-                elif endpoint['device'] in (0x0102, 0x010C, 0x0220):
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0007, 0x21))
-                else:  # 0x0200
-                    # self._zigate.reporting_request(self.addr,
-                    #                               endpoint_id,
-                    #                               0x0300, [(0x0000, 0x20),
-                    #                                        (0x0001, 0x20),
-                    #                                        (0x0003, 0x21),
-                    #                                        (0x0004, 0x21),
-                    #                                        ])
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0000, 0x20))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0001, 0x20))
-                    self._zigate.reporting_request(self.addr,
-                                                   endpoint_id,
-                                                   0x0300, (0x0003, 0x21))
+        with self._zigate.pipeline():
+            for endpoint_id, endpoint in endpoints_list:
+                # if endpoint['device'] in ACTUATORS:  # light
+                LOGGER.debug('Bind and report endpoint %s for device %s', endpoint_id, self)
+#                 if 0x0001 in endpoint['in_clusters']:
+#                     LOGGER.debug('bind and report for cluster 0x0001')
+#                     self._zigate.bind_addr(self.addr, endpoint_id, 0x0001)
+#                     self._zigate.reporting_request(self.addr, endpoint_id,
+#                                                    0x0001, (0x0020, 0x20))
+#                     self._zigate.reporting_request(self.addr, endpoint_id,
+#                                                    0x0001, (0x0021, 0x20))
+                if 0x0006 in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x0006')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0006)
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0006, (0x0000, 0x10))
+                if 0x0008 in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x0008')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0008)
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0008, (0x0000, 0x20))
+                if 0x000f in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x000f')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x000f)
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x000f, (0x0055, 0x10))
+                if 0x0102 in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x0102')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0102)
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0102, (0x0007, 0x20))
+                if 0x0201 in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x0201')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0201)
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x0000, 0x29))
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x0002, 0x18))
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x0008, 0x20))
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x0012, 0x29))
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x0014, 0x29))
+                    self._zigate.reporting_request(self.addr, endpoint_id,
+                                                   0x0201, (0x001C, 0x30))
+                if 0x0300 in endpoint['in_clusters']:
+                    LOGGER.debug('bind and report for cluster 0x0300')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0300)
+                    if endpoint['device'] in (0x0105,):
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0000, 0x20))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0001, 0x20))
+                    elif endpoint['device'] in (0x010D, 0x0210):
+                        # self._zigate.reporting_request(self.addr,
+                        #                               endpoint_id,
+                        #                               0x0300, [(0x0000, 0x20),
+                        #                                        (0x0001, 0x20),
+                        #                                        (0x0003, 0x21),
+                        #                                        (0x0004, 0x21),
+                        #                                        (0x0007, 0x21),
+                        #                                        ])
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0000, 0x20))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0001, 0x20))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0003, 0x21))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0004, 0x21))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0007, 0x21))
+                    elif endpoint['device'] in (0x0102, 0x010C, 0x0220):
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0007, 0x21))
+                    else:  # 0x0200
+                        # self._zigate.reporting_request(self.addr,
+                        #                               endpoint_id,
+                        #                               0x0300, [(0x0000, 0x20),
+                        #                                        (0x0001, 0x20),
+                        #                                        (0x0003, 0x21),
+                        #                                        (0x0004, 0x21),
+                        #                                        ])
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0000, 0x20))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0001, 0x20))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0003, 0x21))
+                        self._zigate.reporting_request(self.addr,
+                                                       endpoint_id,
+                                                       0x0300, (0x0004, 0x21))
+                if 0xFC00 in endpoint['in_clusters']:
+                    LOGGER.debug('bind for cluster 0xFC00')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0xFC00)
+                if 0x0702 in endpoint['in_clusters']:
+                    LOGGER.debug('bind for cluster 0x0702')
+                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0702)
                     self._zigate.reporting_request(self.addr,
                                                    endpoint_id,
-                                                   0x0300, (0x0004, 0x21))
-            if 0xFC00 in endpoint['in_clusters']:
-                LOGGER.debug('bind for cluster 0xFC00')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0xFC00)
-            if 0x0702 in endpoint['in_clusters']:
-                LOGGER.debug('bind for cluster 0x0702')
-                self._zigate.bind_addr(self.addr, endpoint_id, 0x0702)
-                self._zigate.reporting_request(self.addr,
-                                               endpoint_id,
-                                               0x0702, (0x0000, 0x25))
+                                                   0x0702, (0x0000, 0x25))
 
     @staticmethod
     def from_json(data, zigate_instance=None):
@@ -2758,6 +3291,61 @@ class Device(object):
         d._avoid_duplicate()
         return d
 
+    def to_snapshot(self):
+        '''
+        return device as plain data for binary snapshot
+        '''
+        return {'info': self.info,
+                'endpoints': [(k, v['profile'], v['device'], v['in_clusters'], v['out_clusters'],
+                               [cluster.to_snapshot() for cluster in v['clusters'].values()])
+                              for k, v in self.endpoints.items()],
+                'generictype': self.genericType,
+                'discovery': self.discovery
+                }
+
+    @staticmethod
+    def from_snapshot(data, zigate_instance=None):
+        d = Device(data['info'], zigate_instance)
+        d.genericType = data['generictype']
+        d.discovery = data['discovery']
+        for endpoint_id, profile, device, in_clusters, out_clusters, clusters in data['endpoints']:
+            endpoint = d.get_endpoint(endpoint_id)
+            endpoint['profile'] = profile
+            endpoint['device'] = device
+            endpoint['in_clusters'] = in_clusters
+            endpoint['out_clusters'] = out_clusters
+            for cl in clusters:
+                cluster = Cluster.from_snapshot(cl, endpoint, d)
+                endpoint['clusters'][cluster.cluster_id] = cluster
+        d._avoid_duplicate()
+        return d
+
+    def clone(self, zigate_instance=None):
+        '''
+        return a copy of the device sharing no endpoint, cluster or attribute
+        '''
+        def copy_dict(data):
+            # values are mostly immutable, only deep copy containers
+            return {k: copy.deepcopy(v) if isinstance(v, (dict, list, set)) else v
+                    for k, v in data.items()}
+
+        d = Device(copy_dict(self.info), zigate_instance)
+        d.genericType = self.genericType
+        d.discovery = self.discovery
+        for endpoint_id, endpoint in self.endpoints.items():
+            new_endpoint = {k: copy.copy(v) for k, v in endpoint.items() if k != 'clusters'}
+            new_endpoint['clusters'] = {}
+            for cluster_id, cluster in endpoint.get('clusters', {}).items():
+                new_cluster = copy.copy(cluster)
+                new_cluster.attributes = {attribute_id: copy_dict(attribute)
+                                          for attribute_id, attribute in cluster.attributes.items()}
+                new_cluster._endpoint = new_endpoint
+                new_cluster._device = d
+                new_endpoint['clusters'][cluster_id] = new_cluster
+            d.endpoints[endpoint_id] = new_endpoint
+        d._property_index = dict(self._property_index)
+        return d
+
     def to_json(self, properties=False):
         r = {'addr': self.addr,
              'info': self.info,
@@ -2934,12 +3522,13 @@ class Device(object):
                         to_read[k] = []
                     to_read[k].append(0x0000)
 
-        for k, attributes in to_read.items():
-            endpoint, cluster = k
-            self._zigate.read_attribute_request(self.addr,
-                                                endpoint,
-                                                cluster,
-                                                attributes)
+        with self._zigate.pipeline():
+            for k, attributes in to_read.items():
+                endpoint, cluster = k
+                self._zigate.read_attribute_request(self.addr,
+                                                    endpoint,
+                                                    cluster,
+                                                    attributes)
 
     def discover_device(self):
         self._zigate.discover_device(self.addr)
@@ -2994,6 +3583,7 @@ class Device(object):
         self._lock_acquire()
         self.info.update(device.info)
         self._merge_endpoints(device.endpoints)
+        self._avoid_duplicate()
         self.genericType = self.genericType or device.genericType
 #         self.info['last_seen'] = strftime('%Y-%m-%d %H:%M:%S')
         self._lock_release()
@@ -3072,23 +3662,19 @@ class Device(object):
                 self._set_expire_timer(endpoint_id, cluster_id,
                                        attribute['attribute'],
                                        attribute['expire'])
-        self._avoid_duplicate()
+            self._claim_name(endpoint_id, cluster_id, attribute)
         self._lock_release()
         if not r:
             return
+        if self._zigate:
+            self._zigate._journal_attribute(self, endpoint_id, cluster_id, attribute)
         return added, attribute['attribute']
 
     def _delay_change(self, endpoint_id, cluster_id, data):
         '''
             Delay attribute change
         '''
-        timer = threading.Timer(DELAY_FASTCHANGE,
-                                functools.partial(self.set_attribute,
-                                                  endpoint_id,
-                                                  cluster_id,
-                                                  data))
-        timer.setDaemon(True)
-        timer.start()
+        SCHEDULER.schedule(DELAY_FASTCHANGE, self.set_attribute, endpoint_id, cluster_id, data)
 
     def _set_expire_timer(self, endpoint_id, cluster_id, attribute_id, expire):
         LOGGER.debug('Set expire timer for %s-%s-%s in %s', endpoint_id,
@@ -3098,15 +3684,10 @@ class Device(object):
         k = (endpoint_id, cluster_id, attribute_id)
         timer = self._expire_timer.get(k)
         if timer:
-            LOGGER.debug('Cancel previous Timer %s', timer)
-            timer.cancel()
-        timer = threading.Timer(expire,
-                                functools.partial(self._reset_attribute,
-                                                  endpoint_id,
-                                                  cluster_id,
-                                                  attribute_id))
-        timer.setDaemon(True)
-        timer.start()
+            LOGGER.debug('Reschedule previous Timer %s', timer)
+            timer.reschedule(expire)
+            return
+        timer = SCHEDULER.schedule(expire, self._reset_attribute, endpoint_id, cluster_id, attribute_id)
         self._expire_timer[k] = timer
 
     def _reset_attribute(self, endpoint_id, cluster_id, attribute_id):
@@ -3122,6 +3703,8 @@ class Device(object):
             new_value = type(value)()
         attribute['value'] = new_value
         attribute['data'] = new_value
+        if self._zigate:
+            self._zigate._journal_attribute(self, endpoint_id, cluster_id, attribute)
         attribute = self.get_attribute(endpoint_id,
                                        cluster_id,
                                        attribute_id,
@@ -3182,20 +3765,29 @@ class Device(object):
             cluster_id = attribute.pop('cluster')
             self.set_attribute(endpoint_id, cluster_id, attribute)
 
+    def _get_indexed_property(self, name):
+        k = self._property_index.get(name)
+        if k:
+            attribute = self.get_attribute(*k)
+            if attribute and attribute.get('name') == name:
+                return k, attribute
+
     def get_property(self, name, extended_info=False):
         '''
         return attribute matching name
         '''
-        for endpoint_id, endpoint in self.endpoints.items():
-            for cluster_id, cluster in endpoint.get('clusters', {}).items():
-                for attribute in cluster.attributes.values():
-                    if attribute.get('name') == name:
-                        if extended_info:
-                            attr = {'endpoint': endpoint_id,
-                                    'cluster': cluster_id}
-                            attr.update(attribute)
-                            return attr
-                        return attribute
+        r = self._get_indexed_property(name)
+        if not r and name in self._property_index:  # attribute renamed or removed
+            self._avoid_duplicate()
+            r = self._get_indexed_property(name)
+        if r:
+            (endpoint_id, cluster_id, attribute_id), attribute = r
+            if extended_info:
+                attr = {'endpoint': endpoint_id,
+                        'cluster': cluster_id}
+                attr.update(attribute)
+                return attr
+            return attribute
 
     def get_property_value(self, name, default=None):
         '''
@@ -3263,19 +3855,39 @@ class Device(object):
     def _avoid_duplicate(self):
         '''
         Rename attribute if needed to avoid duplicate
+        rebuild the whole name index, lowest endpoint keeps the name
         '''
-        properties = []
-        for attribute in self.attributes:
-            if 'name' not in attribute:
-                continue
-            if attribute['name'] in properties:
-                attribute['name'] = '{}{}'.format(attribute['name'],
-                                                  attribute['endpoint'])
-                attr = self.get_attribute(attribute['endpoint'],
-                                          attribute['cluster'],
-                                          attribute['attribute'])
-                attr['name'] = attribute['name']
-            properties.append(attribute['name'])
+        self._property_index = {}
+        for endpoint_id in sorted(self.endpoints.keys()):
+            endpoint = self.endpoints[endpoint_id]
+            for cluster_id, cluster in list(endpoint.get('clusters', {}).items()):
+                for attribute in list(cluster.attributes.values()):
+                    self._claim_name(endpoint_id, cluster_id, attribute)
+
+    def _claim_name(self, endpoint_id, cluster_id, attribute):
+        '''
+        Add attribute to name index,
+        rename it (or the current owner) if name is already used
+        '''
+        name = attribute.get('name')
+        if not name:
+            return
+        k = (endpoint_id, cluster_id, attribute['attribute'])
+        owner = self._get_indexed_property(name)
+        if owner and owner[0] != k:
+            owner_k, owner_attribute = owner
+            if owner_k[0] <= endpoint_id:
+                attribute['name'] = '{}{}'.format(name, endpoint_id)
+                self._set_name_owner(attribute['name'], k)
+                return
+            owner_attribute['name'] = '{}{}'.format(name, owner_k[0])
+            self._set_name_owner(owner_attribute['name'], owner_k)
+        self._property_index[name] = k
+
+    def _set_name_owner(self, name, k):
+        owner = self._get_indexed_property(name)
+        if not owner or owner[0] == k:
+            self._property_index[name] = k
 
     def __get_template_filename(self):
         typ = self.get_type()
@@ -3294,22 +3906,18 @@ class Device(object):
         if not template_filename:
             LOGGER.warning('Neither type (modelIdentifier) nor manufacturer_code for device {}'.format(self.addr))
             return
-        path = os.path.join(BASE_PATH, 'templates', template_filename + '.json')
-        return os.path.exists(path)
+        return template_filename in TEMPLATES
 
     def load_template(self):
         template_filename = self.__get_template_filename()
         if not template_filename:
             LOGGER.warning('Neither type (modelIdentifier) nor manufacturer_code for device {}'.format(self.addr))
             return
-        path = os.path.join(BASE_PATH, 'templates', template_filename + '.json')
+        template = TEMPLATES.get(template_filename)
         success = False
-        if os.path.exists(path):
+        if template:
             try:
-                with open(path) as fp:
-                    template = json.load(fp)
-                    device = Device.from_json(template)
-                    self.update(device)
+                self.update(template.clone())
                 success = True
             except Exception:
                 LOGGER.error('Failed to load template for {}'.format(template_filename))
@@ -3320,6 +3928,8 @@ class Device(object):
             self._bind_report()
         if success:
             self.discovery = 'templated'
+            if self._zigate:
+                self._zigate._journal_device(self)
             dispatch_signal(ZIGATE_DEVICE_UPDATED,
                             self._zigate, **{'zigate': self._zigate,
                                              'device': self})
@@ -6,35 +6,73 @@
 # For the full copyright and license information, please view the LICENSE
 # file that was distributed with this source code.
 import uuid
+import re
 import json
 import logging
-import sqlite3
 import threading
+import collections
 import time
-from datetime import datetime
 from .const import (LIST_TYPE_CHANNEL_BRAND,
                    LIST_MODEL_DEVICE_BRAND, NAME_TYPE_CHANNEL, TYPE_DEVICE)
 from .config import DATABASE
+from .dbwriter import (DbWriter, ReadConnections, is_write)
+from .migrations import migrate, SCHEMA_VERSION
+from .rule_engine import RuleEngine
 
 LOGGER = logging.getLogger("Database")
-DB_VERSION = 0x0001
+DB_VERSION = SCHEMA_VERSION
+RULE_TABLES = ("conditions", "condition_alarm_mode", "conditions_bind_channel", "actions", "action_channels")
+NOTIFICATION_MAX = 200  # notifications kept
+NOTIFICATION_SLACK = 50  # inserts over NOTIFICATION_MAX before trimming
+NOTIFICATION_PAGE = 50  # default limit of get_notifi
+SNAPSHOT_SECTIONS = ("id", "devices", "rules", "homegate", "rooms", "camera")  # "reload all" payload
+TABLE_SECTIONS = dict({"homegate": ("id", "homegate"), "devices": ("devices",), "channels": ("devices",),
+                       "rules": ("rules",), "rooms": ("rooms",), "cameras": ("camera",)},
+                      **{table: ("rules",) for table in RULE_TABLES})
+WRITE_TABLE = re.compile(r'\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+"?(\w+)',
+                         re.IGNORECASE)
+
+
+class RawJSON(str):
+    """JSON text, published as is by dumps_response"""
+
+
+def dumps_response(data):
+    """json.dumps of a response dict whose value may be RawJSON"""
+    value = data.get("value")
+    if isinstance(value, RawJSON):
+        head = json.dumps({k: v for k, v in data.items() if k != "value"})
+        return '{}, "value": {}}}'.format(head[:-1], value)
+    return json.dumps(data)
 
 
 class DbInterface(object):
     """docstring fs DbInterface."""
 
     def __init__(self, app=None):
-        self._db = sqlite3.connect(DATABASE, check_same_thread=False)
-        self._cursor = self._db.cursor()
+        migrate(DATABASE)
+        self._db = DbWriter(DATABASE)
+        self._readers = ReadConnections(DATABASE)
+        self._queries = {}
+        self._schema = self._load_schema()
+        self._channels = {}  # channel id: cached channel
+        self._channel_ids = {}  # (ieee, endpoint_id): channel id
+        self._rooms = {}  # room id: room row
+        self._alarm_status = None
+        self._generation = 0  # bumped on invalidation, a load started before is not cached
+        self._versions = dict.fromkeys(SNAPSHOT_SECTIONS, 0)
+        self._sections = {}  # section: (version, json text)
+        self._snapshot = None  # (versions, RawJSON)
+        self._write_sections = {}  # write query: sections it changes
+        self._snapshot_lock = threading.Lock()
         self._lock = threading.Lock()
+        self._notifi_count = self.execute("SELECT count(*) FROM notification;").fetchone()[0]
         self.clear_notifi()
         self._alarm_on = self.get_rule_alarm(1)
         self._alarm_off = self.get_rule_alarm(2)
         self._athome = self.get_rule_alarm(3)
         self._sos = self.get_rule_alarm(4)
-        self._door_reminder = {}
-        self._door_sensor = {}
-        self.data_init()
+        self.rule_engine = RuleEngine(self)
     def __enter__(self):
         return self
 
@@ -44,27 +82,36 @@ class DbInterface(object):
     def close(self):
         '''Always remember to close properly for changes to be saved.'''
         if self._db:
-            self._db.commit()
-            self._cursor.close()
             self._db.close()
 
-    def execute(self, *args, **kwargs):
+    def execute(self, query, params=(), durable=False):
+        '''Write statements are queued to the writer thread and return a Future,
+        committed with the next group (at once if durable).
+        Read statements run on a read only connection of the calling thread,
+        they don't see queued writes: call commit() first to read your writes.
+        _add_new (save), _update_* and _remove* commit before returning.'''
         try:
-            self._lock_acquire()
-            return self._cursor.execute(*args, **kwargs)
+            if is_write(query):
+                future = self._db.execute(query, params, durable)
+                self._changed(query)  # after queuing, a rebuild for the new version flushes this write
+                return future
+            return self._readers.db.execute(query, params)
         except Exception as e:
             print(e)
-        finally:
-            self._lock_release()
 
-    def executemany(self, *args, **kwargs):
+    def executemany(self, query, params, durable=False):
         try:
-            self._lock_acquire()
-            return self._cursor.executemany(*args, **kwargs)
+            if is_write(query):
+                future = self._db.executemany(query, params, durable)
+                self._changed(query)  # after queuing, a rebuild for the new version flushes this write
+                return future
+            return self._readers.db.executemany(query, params)
         except Exception as e:
             print(e)
-        finally:
-            self._lock_release()
+
+    def commit(self):
+        '''Wait until queued writes are committed'''
+        self._db.flush()
 
     def _lock_acquire(self):
         LOGGER.debug('Acquire Lock on device %s', self)
@@ -79,6 +126,36 @@ class DbInterface(object):
         else:
             self._lock.release()
 
+    def _load_schema(self):
+        '''Whitelist of tables and their columns, read once from the database.
+        Only these identifiers are formatted into SQL, values are always bound.'''
+        schema = {}
+        for (table,) in self.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall():
+            schema[table] = frozenset(c[1] for c in self.execute('PRAGMA table_info("{}");'.format(table)).fetchall())
+        return schema
+
+    def _check(self, table, *columns):
+        '''Raise ValueError unless table and columns are in the schema'''
+        known = self._schema.get(table)
+        if known is None:
+            raise ValueError('Unknown table {}'.format(table))
+        for column in columns:
+            if column not in known:
+                raise ValueError('Unknown column {}.{}'.format(table, column))
+
+    def _query(self, template, table, *columns):
+        '''SQL text of template for a whitelisted table and columns,
+        a column may be a comma separated list of columns.
+        The text is built once so sqlite statement cache hits on every call.'''
+        key = (template, table) + columns
+        query = self._queries.get(key)
+        if query is None:
+            names = [[c.strip() for c in column.split(',')] for column in columns]
+            self._check(table, *[n for column in names for n in column])
+            query = template.format(table, *[','.join(column) for column in names])
+            self._queries[key] = query
+        return query
+
     def _fetchall(self, table):
         '''Gets and returns an entire row (in a list) of data from the DB given:
         table = Name of the table
@@ -86,7 +163,7 @@ class DbInterface(object):
         value = The number of the row (Primary Key ID)'''
         try:
             # self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
-            return self.execute("SELECT * FROM {};".format(table)).fetchall()
+            return self.execute(self._query("SELECT * FROM {};", table)).fetchall()
         except Exception as e:
                LOGGER.error('Fetchall error %s', e)
 
@@ -97,7 +174,7 @@ class DbInterface(object):
         value = The number of the row (Primary Key ID)'''
         try:
             # self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
-            return self.execute("SELECT {} FROM {};".format(column, table)).fetchall()
+            return self.execute(self._query("SELECT {1} FROM {0};", table, column)).fetchall()
         except Exception as e:
                LOGGER.error('Fetchall col %s', e)
 
@@ -109,7 +186,7 @@ class DbInterface(object):
         '''
         # self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
         try:
-            return self.execute("SELECT * FROM {} WHERE {}='{}';".format(table, column, value)).fetchone()
+            return self.execute(self._query("SELECT * FROM {} WHERE {}=?;", table, column), (value,)).fetchone()
         except Exception as e:
                LOGGER.error('Fetchone error %s', e)
 
@@ -121,25 +198,26 @@ class DbInterface(object):
         '''
         # self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
         try:
-            return self.execute("SELECT * FROM {} WHERE {}='{}';".format(table, column, value)).fetchall()
+            return self.execute(self._query("SELECT * FROM {} WHERE {}=?;", table, column), (value,)).fetchall()
         except Exception as e:
                LOGGER.error('Fetchone col error %s', e)
 
     def _fetch_multi(self, table, column1, column2, condi1, condi2):
         try:
             # self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
-            return self.execute("SELECT * FROM {} WHERE {}='{}' and {}={};".format(table, column1, condi1, column2, condi2)).fetchall()
+            return self.execute(self._query("SELECT * FROM {} WHERE {}=? and {}=?;", table, column1, column2),
+                                (condi1, condi2)).fetchall()
         except Exception as e:
                LOGGER.error('Fetch multi col %s', e)
-    def _add_new(self, table, column, value, save=True):
-        query = "INSERT OR IGNORE INTO {} ({}) VALUES {};".format(
-                table, column, value)
+    def _add_new(self, table, column, value, save=True, durable=False):
         try:
-            LOGGER.debug('ADD NEW DATA: %s', query)
-            ex = self.execute(query)
+            query = self._query("INSERT OR IGNORE INTO {} ({}) VALUES (%s);" % ",".join("?" * len(value)),
+                                table, column)
+            LOGGER.debug('ADD NEW DATA: %s %s', query, value)
+            ex = self.execute(query, value, durable=durable)
             if save and ex:
-                self._db.commit()
-                return ex.lastrowid
+                self.commit()  # wakes the writer, a group commit would wait GROUP_COMMIT_DELAY
+                return ex.result().lastrowid
         except Exception as e:
                LOGGER.error('Insert error: %s', e)
         # finally:
@@ -152,11 +230,11 @@ class DbInterface(object):
         id = The number of the row (Primary Key ID)
         value = The data to be written to this space'''
         try:
-            query = "UPDATE {} SET {}='{}' WHERE id='{}';".format(
-                    table, column, value, id)
+            query = self._query("UPDATE {} SET {}=? WHERE id=?;", table, column)
             # LOGGER.debug('Update one: %s', query)
-            self.execute(query)
-            self._db.commit()
+            ex = self.execute(query, (value, id))
+            self._written(table)
+            ex.result()  # writer error is raised here
         except Exception as e:
                LOGGER.error('UPDATE one error: %s', e)
 
@@ -167,13 +245,12 @@ class DbInterface(object):
         values = A list of the new values to be written
         id = The number of the row (Primary Key ID)'''
         try:
-            query = "UPDATE %s SET " % table
-            for x in range(0, len(columns)):
-                query += ("%s='%s', " % (columns[x], values[x]))
-            query = query[:-2] + (" WHERE id = %s" % (id))
+            query = self._query("UPDATE {} SET %s WHERE id=?;" % ",".join(["{}=?"] * len(columns)),
+                                table, *columns)
             # LOGGER.debug('Update one: %s', query)
-            self.execute(query)
-            self._db.commit()
+            ex = self.execute(query, tuple(value) + (id,))
+            self._written(table)
+            ex.result()
         except Exception as e:
             LOGGER.error('UPDATE all error: %s', e)
 
@@ -186,11 +263,12 @@ class DbInterface(object):
         condition = Where column in db
         '''
         try:
-            query = "UPDATE {} SET {}='{}' WHERE {}='{}';".format(
-                    table, column, value, col_condition, value_condition)
+            query = self._query("UPDATE {} SET {}=? WHERE {}=?;", table, column, col_condition)
             # LOGGER.debug('Update one col: %s', query)
-            if self.execute(query):
-                self._db.commit()
+            ex = self.execute(query, (value, value_condition))
+            if ex:
+                self._written(table)
+                ex.result()
         except Exception as e:
                LOGGER.error('UPDATE one col error: %s', e)
 
@@ -199,34 +277,105 @@ class DbInterface(object):
 
     def _remove(self, table, column, value):
         try:
-            query = "DELETE FROM {} WHERE {}='{}';".format(
-                    table, column, value)
-            if self.execute(query):
-                self._db.commit()
+            query = self._query("DELETE FROM {} WHERE {}=?;", table, column)
+            ex = self.execute(query, (value,))
+            if ex:
+                self._written(table)
+                ex.result()
                 return True
         except Exception as e:
                LOGGER.error("REMOVE row in table error : %s", e)
                return False
     def _remove_muti(self, table, column1, column2, value1, value2):
         try:
-            query = "DELETE FROM {} WHERE {}='{}' AND {}='{}';".format(
-                    table, column1, value1, column2, value2)
-            if self.execute(query):
-                self._db.commit()
+            query = self._query("DELETE FROM {} WHERE {}=? AND {}=?;", table, column1, column2)
+            ex = self.execute(query, (value1, value2))
+            if ex:
+                self._written(table)
+                ex.result()
                 return True
         except Exception as e:
                LOGGER.error("REMOVE muti row in table error : %s", e)
                return False
 
+    ##### CACHE ##########
+    # Channels, rooms and alarm status read on every sensor report are kept in memory.
+    # Channel status is written through, other writes to these tables invalidate
+    # once committed, readers don't see them before.
+
+    def _written(self, table, id=None):
+        '''Commit queued writes to table, drop its cached rows before and after'''
+        self._invalidate(table, id)
+        self.commit()
+        self._invalidate(table, id)
+
+    def _invalidate(self, table, id=None):
+        '''Drop cached rows of table, all rows if id is None'''
+        self._generation += 1
+        if table == "channels":
+            if id is None:
+                self._channels.clear()
+                self._channel_ids.clear()
+            else:
+                entry = self._channels.pop(id, None)
+                if entry:
+                    self._channel_ids.pop((entry["ieee"], entry["endpoint_id"]), None)
+        elif table == "rooms":
+            if id is None:
+                self._rooms.clear()
+            else:
+                self._rooms.pop(id, None)
+        elif table == "rules":
+            self._alarm_status = None
+
+    def _cached_channel(self, ieee, endpoint_id):
+        '''Cached channel of ieee and endpoint, loaded on first use'''
+        key = (ieee, int(endpoint_id))
+        entry = self._channels.get(self._channel_ids.get(key))
+        if entry is None:
+            generation = self._generation
+            c = self.execute("SELECT id,type,status,name,notification,room_id,zone_status FROM channels where ieee=? and endpoint_id=?;",
+                             key).fetchone()
+            if c is None:
+                return None
+            entry = {"id": c[0], "type": c[1], "status": json.loads(c[2]), "status_json": c[2], "name": c[3],
+                     "notification": c[4], "room_id": c[5], "zone_status": c[6], "ieee": key[0], "endpoint_id": key[1]}
+            if generation == self._generation:
+                self._channels[c[0]] = entry
+                self._channel_ids[key] = c[0]
+        return entry
+
+    def _write_channel_status(self, channel_id, channel_status, timer, durable=False):
+        '''Write channel status to database and cache'''
+        status_json = json.dumps(channel_status)
+        self.execute("UPDATE channels SET status=?,updated=? WHERE id=?;", (status_json, timer, channel_id), durable=durable)
+        entry = self._channels.get(channel_id)
+        if entry:
+            entry["status"] = [dict(s) for s in channel_status]
+            entry["status_json"] = status_json
+
+    def _room(self, room_id):
+        room = self._rooms.get(room_id)
+        if room is None:
+            generation = self._generation
+            room = self._fetchone("rooms", "id", room_id)
+            if room and generation == self._generation:
+                self._rooms[room_id] = room
+        return room
+
+    def _dict_rows(self, cursor):
+        '''Rows of cursor as dicts, per cursor: connections are shared by every query'''
+        if cursor is not None:
+            cursor.row_factory = lambda c, r: dict(
+                [(column[0], r[idx]) for idx, column in enumerate(c.description)])
+        return cursor
+
     def _to_dict(self, value):
         if value:
             return json.loads(value)
         else:
             return None
 
-    def data_init(self):
-        id = self._fetchone("rules","type",5)[0]
-        self._door_reminder = self.get_rule(id=id)
     ##### ADD_NEW DEVICE #######
 
     def _save_device(self, device):
@@ -248,7 +397,7 @@ class DbInterface(object):
                LOGGER.debug('Update channel info :%',device_id)
                self._add_new_channels(
                    device_id[0], id[1], ieee, device.get('endpoints', []))
-               self._db.commit()
+               self.commit()
                return self.get_device_channel(id=device_id[0])
            else:
                LOGGER.debug('Create new device')
@@ -261,7 +410,7 @@ class DbInterface(object):
                    detail.get("power_type", 0), detail.get("server_mask", 0), int(detail.get("rejoin_status", 0)), int(time.time()), int(time.time()), int(time.time())))
 
                self._add_new_channels(id[0], id[1], ieee, device['endpoints'])
-               self._db.commit()
+               self.commit()
                return self.get_device_channel(id=id[0])
         except Exception as e:
              LOGGER.debug('Add new device error : %s',exc_info=True)
@@ -270,10 +419,10 @@ class DbInterface(object):
         zone_id = self.generate_zone_id()
         for endpoint in enpoints:
             self._add_new("channels", "id, ieee, endpoint_id, type, config, profile_id, device_type, in_clusters, out_clusters,zone_id,zone_status, created, updated, favorite,notification,device_id", (channel_id, ieee,
-                                                                                                                                                                                                         endpoint['endpoint'], 0, config, endpoint['profile'], endpoint['device'], json.dumps(endpoint['in_clusters']), json.dumps(endpoint['out_clusters']), zone_id, 1, int(time.time()), int(time.time()), 0, 0, device_id))
+                                                                                                                                                                                                         endpoint['endpoint'], 0, config, endpoint['profile'], endpoint['device'], json.dumps(endpoint['in_clusters']), json.dumps(endpoint['out_clusters']), zone_id, 1, int(time.time()), int(time.time()), 0, 0, device_id), save=False)
             for cluster in endpoint['in_clusters']:
                 self._add_new("clusters", "ieee, endpoint_id, cluster",
-                                          (ieee, endpoint['endpoint'], cluster))
+                                          (ieee, endpoint['endpoint'], cluster), save=False)
             list_status = {}
             type_channel = None
             for cluster in list(endpoint['clusters']):
@@ -283,9 +432,9 @@ class DbInterface(object):
                         if model:
                             self.set_device_type(model, device_id)
                             type_channel = self.set_type_channels(model, channel_id)
-                            self._db.commit()
+                            self.commit()
                             self._add_new("attributes", "ieee,endpoint_id,cluster,attribute,expire,data,name,type,value", (ieee, endpoint['endpoint'], cluster['cluster'], attribute['attribute'],
-                                                                                                                           attribute.get('expire', 0), attribute.get('data', None), attribute.get('name', None), attribute.get('type', None), attribute.get('value', None)))
+                                                                                                                           attribute.get('expire', 0), attribute.get('data', None), attribute.get('name', None), attribute.get('type', None), attribute.get('value', None)), save=False)
                         else:
                             self.remove_device(device_id)
                             break
@@ -296,7 +445,7 @@ class DbInterface(object):
                                         "restore": int(value['restore']), "trouble": int(value['trouble']), "ac_fault": int(value['ac_fault']), "test_mode": int(value['test_mode']),
                                         "battery_defect": int(value['battery_defect']), "armed": int(value['armed']), "disarmed": int(value['disarmed']), "athome": int(value['athome'])}
                         self._add_new("attributes", "ieee, endpoint_id, cluster, attribute, zone_status,name, type", (
-                            ieee, endpoint['endpoint'], cluster['cluster'], attribute['attribute'], json.dumps(alarm_status), attribute['name'], attribute['type']))
+                            ieee, endpoint['endpoint'], cluster['cluster'], attribute['attribute'], json.dumps(alarm_status), attribute['name'], attribute['type']), save=False)
                         # channel_info = self.execute("SELECT type,ieee,zone_id FROM channels WHERE id='{}';".format(channel_id)).fetchone()
                         self.set_status_channel(alarm_status, channel_id, type_channel)
                         self.add_device_to_rule_secure(channel_id, type_channel, ieee)
@@ -313,7 +462,7 @@ class DbInterface(object):
                             pass
                     # OTHER DEVICE
                         self._add_new("attributes", "ieee,endpoint_id,cluster,attribute,expire,data,name,type,value", (ieee, endpoint['endpoint'], cluster['cluster'], attribute['attribute'],
-                                                                                                                       attribute.get('expire', 0), attribute.get('data', None), attribute.get('name', None), attribute.get('type', None), attribute.get('value', None)))
+                                                                                                                       attribute.get('expire', 0), attribute.get('data', None), attribute.get('name', None), attribute.get('type', None), attribute.get('value', None)), save=False)
 
             if not list_status:
                  pass
@@ -325,6 +474,14 @@ class DbInterface(object):
     def _load_device(self):
         try:
             devices = []
+            channel_rows = collections.defaultdict(list)
+            for endt in self.execute("""SELECT c.* FROM channels c WHERE c.ieee IN (SELECT ieee FROM devices)
+                                        ORDER BY c.ieee, c.endpoint_id;""").fetchall():
+                channel_rows[endt[2]].append(endt)
+            attribute_rows = collections.defaultdict(list)
+            for cl in self.execute("""SELECT a.* FROM attributes a WHERE a.ieee IN (SELECT ieee FROM devices)
+                                      ORDER BY a.ieee, a.endpoint_id, a.cluster, a.attribute;""").fetchall():
+                attribute_rows[(cl[0], cl[2])].append(cl)
             for ieee in self._fetchall("devices"):
                 device = {}
                 device["addr"] = ieee[2]
@@ -334,7 +491,7 @@ class DbInterface(object):
                                   "ieee": ieee[3], "last_seen": ieee[24], "lqi": ieee[15], "mac_capability": ieee[16], "manufacturer_code": ieee[17],
                                   "power_type": ieee[18], "server_mask": ieee[20], "rejoin_status": ieee[21]}
                 enpoints = []
-                for endt in self._fetch_by_col("channels", 'ieee', ieee[3]):
+                for endt in channel_rows.get(ieee[3], ()):
                     enpoint = {}
                     enpoint["device"] = endt[8]
                     enpoint["endpoint"] = endt[3]
@@ -346,7 +503,7 @@ class DbInterface(object):
                         cluster = {}
                         cluster["cluster"] = clu
                         attributes = []
-                        for cl in self._fetch_multi("attributes", "ieee", "cluster", ieee[3], clu):
+                        for cl in attribute_rows.get((ieee[3], clu), ()):
                             attribute = {}
                             attribute["attribute"] = cl[3]
                             attribute["expire"] = cl[4]
@@ -373,10 +530,8 @@ class DbInterface(object):
 
     ######   HOMEGATE ##########
     def get_homegate_info(self):
-        self._db.row_factory = lambda c, r: dict(
-            [(column[0], r[idx]) for idx, column in enumerate(c.description)])
         query = "SELECT id,name,model,serial, ip_local, ip_public, zig_version, sw_version, config, updated, last_update FROM homegate"
-        hg = self.execute(query)
+        hg = self._dict_rows(self.execute(query))
         data = {"id": hg[0], "name": hg[1], "model": hg[2], "serial_number": hg[3], "ip_local": hg[4], "ip_public": hg[5],
                 "zig_version": hg[6], "sw_version": hg[7], "config": self._to_dict(hg[8]), "updated": hg[9], "last_update": hg[10]}
         return data
@@ -402,7 +557,7 @@ class DbInterface(object):
                        """
             self.execute(query, (data.id, data.name, data.site, data.wan_mac, data.wwan_mac, data.ip_local, data.ip_public, data.model,
                                  data.serial, data.state, json.dumps(data.config), data.zig_version, data.hw_version, data.sw_version,int(time.time()), int(time.time())))
-            self._db.commit()
+            self.commit()
             return True
         except Exception as e:
             print(e)
@@ -410,26 +565,61 @@ class DbInterface(object):
 
     def update_homegate_info(self, colum, value, id):
         try:
-            query = "UPDATE homegate SET {}='{}' WHERE id='{}'".format(
-                    colum, value, id)
-            self.execute(query)
-            self._db.commit()
+            query = self._query("UPDATE {} SET {}=? WHERE id=?;", "homegate", colum)
+            self.execute(query, (value, id))
+            self.commit()
             return True
         except Exception as e:
             return e
             print(e)
 
     def update_total_homegate_db(self):
-        list = {}
-        hg = self.get_homegate_info_all()
-        list['id'] = hg['id']
-        list['devices'] = self.get_device_channel(all=True)
-        list['rules'] = self.get_rule(all=True)
-        list['homegate'] = hg
-        list['rooms'] = self.get_room(all=True)
-        list['camera'] = self.get_camera(all=True)
-        list['groups'] = None
-        return list
+        return json.loads(self.reload_snapshot())
+
+    def reload_snapshot(self):
+        '''"reload all" payload as RawJSON, ready to publish.
+        Kept in memory, only sections changed since last call are rebuilt.'''
+        with self._snapshot_lock:
+            versions = tuple(self._versions[section] for section in SNAPSHOT_SECTIONS)
+            if self._snapshot and self._snapshot[0] == versions:
+                return self._snapshot[1]
+            snapshot = RawJSON("{" + ", ".join('"{}": {}'.format(section, self._section(section))
+                                               for section in SNAPSHOT_SECTIONS) + ', "groups": null}')
+            self._snapshot = (versions, snapshot)
+            return snapshot
+
+    def _section(self, section):
+        '''JSON text of a snapshot section, rebuilt if its version changed'''
+        version = self._versions[section]
+        cached = self._sections.get(section)
+        if cached and cached[0] == version:
+            return cached[1]
+        self.commit()  # writes counted in version are readable
+        if section == "id":
+            value = self.get_homegate_info_all()['id']
+        elif section == "devices":
+            value = self.get_device_channel(all=True)
+        elif section == "rules":
+            value = self.get_rule(all=True)
+        elif section == "homegate":
+            value = self.get_homegate_info_all()
+        elif section == "rooms":
+            value = self.get_room(all=True)
+        else:
+            value = self.get_camera(all=True)
+        text = json.dumps(value)
+        self._sections[section] = (version, text)
+        return text
+
+    def _changed(self, query):
+        '''Bump version of snapshot sections changed by a write query'''
+        sections = self._write_sections.get(query)
+        if sections is None:
+            m = WRITE_TABLE.match(query)
+            sections = TABLE_SECTIONS.get(m.group(1).lower(), ()) if m else SNAPSHOT_SECTIONS
+            self._write_sections[query] = sections
+        for section in sections:
+            self._versions[section] += 1
     ###### USER ##########
 
     def get_user(self, id):
@@ -492,11 +682,11 @@ class DbInterface(object):
 
     def update_room(self,data):
         try:
-            query = """update rooms set name='{}',channels='{}',icon='{}',
-                       floor_id='{}',updated='{}' where id='{}';""".format(data['name'],jsont.dumps(data['channels']),
-                                                                           data['icon'],data['floor_id'],data['id'])
-            self.execute(query)
-            self._db.commit()
+            query = """update rooms set name=?,channels=?,icon=?,
+                       floor_id=?,updated=? where id=?;"""
+            self.execute(query, (data['name'], jsont.dumps(data['channels']),
+                                 data['icon'], data['floor_id'], int(time.time()), data['id']))
+            self._written("rooms", data['id'])
             return self.get_room(id=data['id'])
         except Exception as e:
                LOGGER.error("Update room error : ",exc_info=True)
@@ -507,67 +697,17 @@ class DbInterface(object):
         else:
            return False
 ###### RULE ##########
-    def check_rule_timer(self):
-        list_actions = []
-        for t in self.execute("select id,timer from conditions;").fetchall():
-            condi = json.loads(t)
-            print(condi)
-            if currentDay in condi['repeat']:
-               if condi['type']== 0 and condi['type']== 1: # 0 is moment , 1 is period
-                  if condi['value']['start_time'] == currentTime:
-                     rule = self.execute("select id,stauts,type from rules where id='{}';".format(condi['id'])).fetchone()
-                     print("Rule",rule)
-                     action = self.execute("select * from actions where id='{}'".format(condi['id'])).fetchone()
-                     print("Action rule",action)
-                     if action:
-                         list_actions['channels'] = json.loads(action[2])
-                         list_actions['notification'] = action[3]
-                     action_channels = self._fetch_by_col("action_channels", "id",condi['id'])
-                     if action_channels:
-                        for c in action_channels:
-                              list_actions['channels'] = {"id":c[1],"ieee":c[3],"type":c[4],"status":c[5]}
-        return list_actions
-    def compare_date_time(self,type,repeat,start_time,end_time):
-        currentTime = datetime.now().strftime("%H:%M")
-        currentDay  = datetime.today().weekday() + 2
-        if currentDay in repeat and repeat is not None:
-           if type:
-               if currentTime == start_time:
-                   return True
-               else:
-                   return False
-           else:
-               now = datetime.now()
-               st_time = datetime.strptime(start_time, '%H:%M')
-               st_time = now.replace(hour=st_time.hour,minute=st_time.minute)
-               e_time = datetime.strptime(end_time, '%H:%M')
-               e_time = now.replace(hour=e_time.hour,minute=e_time.minute)
-               if st_time <= now <= e_time:
-                  return True
-               else:
-                   return False
-
-    def check_door_open(self):
-        if self._door_reminder:
-           for d in self._door_reminder['conditions']['alarm_mode']:
-               print("check door timer",d)
-               if d['channel_id'] in self._door_sensor:
-                   door = self._door_sensor[d['channel_id']]
-                   check_time = int(time.time())-int(door['updated'])  # cout time , 180 is 180 second
-                   if check_time > 160:
-                       timer = self._door_reminder['conditions']['timer']
-                       print(timer)
-                       if timer is not None:
-                          if self.compare_date_time(1,timer['repeat'],timer['value']['start_time'],timer['value']['end_time']):
-                             return self.notifi_rule_door_reminder(door['id'],door['name'],d['channel_id'])
-                          else:
-                               break
-                       else:
-                           return self.notifi_rule_door_reminder(door['id'],door['name'],d['channel_id'])
-
-    def notifi_rule_door_reminder(self,rule_id,rule_name,channel):
-        room_name = self._fetchone("rooms", "id",self._door_sensor[channel]['room_id'])
-        notifi = self.add_notifi("", rule_id,4,5,rule_name,self._door_sensor[channel], room_name[1])
+    def check_rule_timer(self, now=None):
+        '''Actions of timer rules due this minute'''
+        return self.rule_engine.timer_actions(now)
+
+    def check_door_open(self, now=None):
+        '''Notify door reminders of doors left open, return notifications'''
+        return [self.notifi_rule_door_reminder(door) for rule, door in self.rule_engine.doors_due(now)]
+
+    def notifi_rule_door_reminder(self, door):
+        room_name = self._room(door['room_id'])
+        notifi = self.add_notifi("", door['id'], 4, 5, door['name'], door, room_name[1] if room_name else None)
         return notifi
     def add_device_to_rule_secure(self, channel_id, type, ieee):
         zone_status = 1
@@ -584,9 +724,9 @@ class DbInterface(object):
             if type == 9:
                 zone_status = 0
             self._add_new("condition_alarm_mode", "id,channel_id,ieee,zone_status",
-                          (self._alarm_on[0], channel_id, ieee, zone_status))
+                          (self._alarm_on[0], channel_id, ieee, zone_status), save=False)
             self._add_new("condition_alarm_mode", "id,channel_id,ieee,zone_status",
-                          (self._athome[0], channel_id, ieee, zone_status))
+                          (self._athome[0], channel_id, ieee, zone_status), save=False)
         elif type == 15:
             ''' Add remote control to alarm mode
                        "access_control":{
@@ -595,11 +735,11 @@ class DbInterface(object):
                                                                             }
             '''
             self._add_new("conditions_bind_channel", "id,channel_id,channel_type",
-                          (self._alarm_on[0], channel_id, type))
+                          (self._alarm_on[0], channel_id, type), save=False)
             self._add_new("conditions_bind_channel", "id,channel_id,channel_type",
-                          (self._athome[0], channel_id, type))
+                          (self._athome[0], channel_id, type), save=False)
             self._add_new("conditions_bind_channel",
-                          "id,channel_id,channel_type", (self._sos[0], channel_id, type))
+                          "id,channel_id,channel_type", (self._sos[0], channel_id, type), save=False)
         elif type == 21:
             '''' Add siren to Alarm mode
                               "channels":[   { "channel_id":"{string}",
@@ -611,106 +751,58 @@ class DbInterface(object):
             siren = [{"type": "volume", "value": 1},
                      {"type": "duration", "value": 180}]
             self._add_new("action_channels", "id,channel_id,channel_ieee,channel_type,channel_status",
-                          (self._alarm_on[0], channel_id, ieee, type, json.dumps(siren)))
+                          (self._alarm_on[0], channel_id, ieee, type, json.dumps(siren)), save=False)
             self._add_new("action_channels", "id,channel_id,channel_ieee,channel_type,channel_status",
-                          (self._athome[0], channel_id, ieee, type, json.dumps(siren)))
+                          (self._athome[0], channel_id, ieee, type, json.dumps(siren)), save=False)
             self._add_new("action_channels", "id,channel_id,channel_ieee,channel_type,channel_status",
-                          (self._sos[0], channel_id, ieee, type, json.dumps(siren)))
+                          (self._sos[0], channel_id, ieee, type, json.dumps(siren)), save=False)
         else:
             pass
 
+    def _load_rules(self, where="", params=()):
+        '''Rules with their conditions and actions, rules filtered by where on alias r.
+        One query per table, rows of a rule are grouped in Python.'''
+        rules = self.execute("SELECT r.* FROM rules r" + where + ";", params).fetchall()
+        children = {}
+        for table in RULE_TABLES:
+            rows = children[table] = collections.defaultdict(list)
+            query = self._query("SELECT t.* FROM {} t JOIN rules r ON r.id = t.id" + where + " ORDER BY t.rowid;", table)
+            for row in self.execute(query, params).fetchall():
+                rows[row[0]].append(row)
+        return [self._rule_dict(r, children) for r in rules]
+
+    def _rule_dict(self, r, children):
+        rule = {"id": r[0], "name": r[1], "status": r[2], "created": r[3], "updated": r[4],
+                "user_id": r[5], "homegate_id": r[6], "type": r[7], "favorite": bool(r[8])}
+        for c in children["conditions"].get(r[0], ()):
+            alarm_mode = []
+            for a in children["condition_alarm_mode"].get(r[0], ()):
+                alarm_mode.append({"channel_id": a[1], "ieee": a[2], "zone_status": a[3]})
+            access_control = json.loads(c[3])
+            for b in children["conditions_bind_channel"].get(r[0], ()):
+                if access_control['bind_channel_ids'] is None:
+                    access_control['bind_channel_ids'] = [{"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]}]
+                else:
+                    access_control['bind_channel_ids'].append({"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]})
+            rule["conditions"] = {"alarm_mode": alarm_mode, "auto_mode": self._to_dict(c[1]), "timer": self._to_dict(c[2]), "access_control": access_control}
+        for a in children["actions"].get(r[0], ()):
+            action_channels = []
+            for ac in children["action_channels"].get(r[0], ()):
+                action_channels.append({"channel_id": ac[1], "channel_ieee": ac[3], "channel_icon": ac[2], "channel_type": ac[4], "channel_status": json.loads(ac[5])})
+            rule["actions"] = {"delay": a[1], "channels": action_channels, "rules": self._to_dict(a[2]), "activate_notification": a[3]}
+        return rule
+
     def get_rule(self, all=False, id=False):
         try:
-           list_rules = []
            if all:
-
-               for r in self._fetchall("rules"):
-                   list = {"id": r[0], "name": r[1], "status": r[2], "created": r[3], "updated": r[4],
-                           "user_id": r[5], "homegate_id": r[6], "type": r[7], "favorite": bool(r[8])}
-                   conditions = {}
-                   for c in self._fetch_by_col("conditions", "id", r[0]):
-                       alarm_mode = []
-                       for a in self._fetch_by_col("condition_alarm_mode", "id", r[0]):
-                           if a:
-                               alarm_mode.append({"channel_id": a[1], "ieee": a[2], "zone_status": a[3]})
-                       access_control = json.loads(c[3])
-
-                       for b in self._fetch_by_col("conditions_bind_channel", "id", r[0]):
-                           if access_control['bind_channel_ids'] is None:
-                               access_control['bind_channel_ids'] = [{"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]}]
-                           else:
-                               access_control['bind_channel_ids'].append({"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]})
-                       list["conditions"] = {"alarm_mode": alarm_mode, "auto_mode": self._to_dict(c[1]), "timer": self._to_dict(c[2]), "access_control": access_control}
-                   for a in self._fetch_by_col("actions", "id", r[0]):
-                       action_channels = []
-                       for ac in self._fetch_by_col("action_channels", "id", r[0]):
-                           if ac:
-                               action_channels.append({"channel_id": ac[1], "channel_ieee": ac[3], "channel_icon": ac[2], "channel_type": ac[4], "channel_status": json.loads(ac[5])})
-                       list["actions"] = {"delay": a[1], "channels": action_channels, "rules": self._to_dict(a[2]), "activate_notification": a[3]}
-
-                   list_rules.append(list)
-               return list_rules
+               return self._load_rules()
            if id:
-               for r in self.execute("select * from rules where id='{}';".format(id)).fetchall():
-                   list = {"id": r[0], "name": r[1], "status": r[2], "created": r[3], "updated": r[4],
-                           "user_id": r[5], "homegate_id": r[6], "type": r[7], "favorite": bool(r[8])}
-                   conditions = {}
-                   for c in self._fetch_by_col("conditions", "id", r[0]):
-                       alarm_mode = []
-                       for a in self._fetch_by_col("condition_alarm_mode", "id", r[0]):
-                           if a:
-                               alarm_mode.append({"channel_id": a[1], "ieee": a[2], "zone_status": a[3]})
-                       access_control = json.loads(c[3])
-                       for b in self._fetch_by_col("conditions_bind_channel", "id", r[0]):
-                           if access_control['bind_channel_ids'] is None:
-                               access_control['bind_channel_ids'] = [{"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]}]
-                           else:
-                               access_control['bind_channel_ids'].append({"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]})
-                       list["conditions"] = {"alarm_mode": alarm_mode, "auto_mode": self._to_dict(c[1]), "timer": self._to_dict(c[2]), "access_control": access_control}
-                   for a in self._fetch_by_col("actions", "id", r[0]):
-                       action_channels = []
-                       for ac in self._fetch_by_col("action_channels", "id", r[0]):
-                           if ac:
-                               action_channels.append({"channel_id": ac[1], "channel_ieee": ac[3], "channel_icon": ac[2], "channel_type": ac[4], "channel_status": json.loads(ac[5])})
-                       list["actions"] = {"delay": a[1], "channels": action_channels, "rules": self._to_dict(a[2]), "activate_notification": a[3]}
-                   list_rules.append(list)
-               return list_rules[0]
+               return self._load_rules(" WHERE r.id=?", (id,))[0]
         except Exception as e:
         	 LOGGER.debug('Get rule Error : %s',e)
 
     def get_rule_secure(self):
-        list_rules = []
-        query = "SELECT * from rules where type >0 and type <6;"
-        rules = self.execute(query).fetchall()
-        for r in rules:
-            list = {"id": r[0], "name": r[1], "status": r[2], "created": r[3], "updated": r[4],
-                    "user_id": r[5], "homegate_id": r[6], "type": r[7], "favorite": bool(r[8])}
-            conditions = {}
-            for c in self._fetch_by_col("conditions", "id", r[0]):
-                alarm_mode = []
-                for a in self._fetch_by_col("condition_alarm_mode", "id", r[0]):
-                    if a:
-                        alarm_mode.append(
-                            {"channel_id": a[1], "ieee": a[2], "zone_status": a[3]})
-                access_control = json.loads(c[3])
-
-                for b in self._fetch_by_col("conditions_bind_channel", "id", r[0]):
-                    if access_control['bind_channel_ids'] is None:
-                        access_control['bind_channel_ids'] = [
-                            {"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]}]
-                    else:
-                        access_control['bind_channel_ids'].append(
-                            {"channel_id": b[1], "channel_ieee": b[2], "channel_type": b[3], "channel_status": b[4]})
-                list["conditions"] = {"alarm_mode": alarm_mode, "auto_mode": self._to_dict(c[1]), "timer": self._to_dict(c[2]), "access_control": access_control}
-            for a in self._fetch_by_col("actions", "id", r[0]):
-                action_channels = []
-                for ac in self._fetch_by_col("action_channels", "id", r[0]):
-                    if ac:
-                        action_channels.append(
-                            {"channel_id": ac[1], "channel_ieee": ac[3], "channel_icon": ac[2], "channel_type": ac[4], "channel_status": json.loads(ac[5])})
-                list["actions"] = {"delay": a[1], "channels": action_channels, "rules": self._to_dict(a[2]), "activate_notification": a[3]}
-            list_rules.append(list)
-        return list_rules
+        return self._load_rules(" WHERE r.type >0 and r.type <6")
 
     def remove_rule(self, id):
         self._remove("conditions", "id", id)
@@ -755,27 +847,27 @@ class DbInterface(object):
             self.execute(query1)
             query3 = "UPDATE rules SET status=1 WHERE type=2;"
             self.execute(query3)
-            self._db.commit()
+            self._written("rules")
             return self._alarm_off
         elif type == 1 and status == 1:
             query1 = "UPDATE rules SET status=0 WHERE type=2 OR type=3;"
             self.execute(query1)
             query2 = "UPDATE rules SET status=1 WHERE type=1;"
             self.execute(query2)
-            self._db.commit()
+            self._written("rules")
             return self.change_zone_status(type)
         elif type == 3 and status == 1:
             query1 = "UPDATE rules SET status=0 WHERE type=1 OR type=2;"
             self.execute(query1)
             query2 = "UPDATE rules SET status=1 WHERE type=3;"
             self.execute(query2)
-            self._db.commit()
+            self._written("rules")
             return self.change_zone_status(type)
         elif type == 4 and status == 1:
             id_sos = self.execute(
-                "SELECT id FROM rules WHERE type='{}';".format(4)).fetchone()[0]
+                "SELECT id FROM rules WHERE type=?;", (4,)).fetchone()[0]
             action_alarm = self.execute(
-                "SELECT channels FROM action WHERE id='{}';".format(id_sos)).fetchone()[0]
+                "SELECT channels FROM action WHERE id=?;", (id_sos,)).fetchone()[0]
             list_channel = []
             if action_alarm:
                 for c in json.loads(action_alarm):
@@ -788,45 +880,45 @@ class DbInterface(object):
     def change_zone_status(self, type):
         ''' Change zone status in alarm mode
         '''
-        self._db.row_factory = lambda c, r: dict(
-            [(column[0], r[idx]) for idx, column in enumerate(c.description)])
         condi_alarm = self.execute(
-            "SELECT ieee,zone_status FROM condition_alarm_mode WHERE id='{}';".format(self._athome[0])).fetchall()
+            "SELECT ieee,zone_status FROM condition_alarm_mode WHERE id=?;", (self._athome[0],)).fetchall()
         list_channel = []
         if condi_alarm:
-            for c in condi_alarm:
-                if type == 1 and c['zone_status'] == 0:
-                    list_channel.append({"ieee": c['ieee'], "zone_status": 1})
+            for ieee, zone_status in condi_alarm:
+                if type == 1 and zone_status == 0:
+                    list_channel.append({"ieee": ieee, "zone_status": 1})
                 else:
                     list_channel.append(
-                        {"ieee": c['ieee'], "zone_status": c['zone_status']})
+                        {"ieee": ieee, "zone_status": zone_status})
         if type == 1:
             return {"id": self._alarm_on[0], "channels": list_channel}
         else:
             return {"id": self._athome[0], "channels": list_channel}
 
     def get_rule_alarm_status(self):
-        status = self.execute("SELECT status from rules where type<3;").fetchall()
-        if status[0][0] == 1 or status[2][0] == 1:
-           return 1
-        else:
-           return 0
+        '''1 when armed: AlarmOn (type 1) or AtHome (type 3) rule is on'''
+        alarm_status = self._alarm_status
+        if alarm_status is None:
+            generation = self._generation
+            status = self.execute("SELECT max(status) FROM rules WHERE type IN (1, 3);").fetchone()
+            alarm_status = 1 if status and status[0] == 1 else 0
+            if generation == self._generation:
+                self._alarm_status = alarm_status
+        return alarm_status
     def get_rule_alarm(self, type):
-        return self.execute("SELECT id,type,status FROM rules WHERE type='{}';".format(type)).fetchone()
+        return self.execute("SELECT id,type,status FROM rules WHERE type=?;", (type,)).fetchone()
     ###### DEVICE ##########
 
     def get_device(self, all=None, id=None):
-        self._db.row_factory = lambda c, r: dict(
-            [(column[0], r[idx]) for idx, column in enumerate(c.description)])
         try:
             if all is not None:
                 query_all = """SELECT id, ieee, addr, type, model, manufacturer, serial_number, sw_version, hw_version,
 							   lqi,low_battery, created, updated from devices;"""
-                return self.execute(query_all)
+                return self._dict_rows(self.execute(query_all))
             elif id is not None:
                 query_id = """SELECT id, ieee, addr, type, model, manufacturer, serial_number, sw_version, hw_version, zone_id, zone_status,
 								lqi,low_battery, created, updated from devices where id=? ;"""
-                return self.execute(query_all, id)
+                return self._dict_rows(self.execute(query_all, id))
             else:
                 return "No param selected"
         except Exception as e:
@@ -838,30 +930,30 @@ class DbInterface(object):
             if all:
                 query_all = """SELECT id, ieee, addr, type, model, manufacturer, serial_number, sw_version, hw_version,
 							   lqi,low_battery, created, updated , name from devices;"""
+                query_channel = """SELECT c.id, c.name, c.endpoint_id, c.type, c.status, c.config, c.zone_id, c.zone_status, c.created, c.updated,
+                                   c.favorite, c.notification, c.room_id, c.device_id from channels c
+                                   JOIN devices d ON d.id = c.device_id ORDER BY c.rowid;"""
+                device_channels = collections.defaultdict(list)
+                for c in self.execute(query_channel).fetchall():
+                    channel = {"id": c[0], "name": c[1], "endpoint": c[2], "type": c[3], "status": json.loads(c[4]), "config": c[5], "zone_id": c[6], "zone_status": c[7],
+                               "created": c[8], "updated": c[9], "favorite": bool(c[10]), "notification": c[11], "room_id": c[12], "device_id": c[13]}
+                    device_channels[c[13]].append(channel)
                 for d in self.execute(query_all).fetchall():
                     device = {"id": d[0], "ieee": d[1], "addr": d[2], "type": d[3], "model": d[4], "manufacturer": d[5], "serial_number": d[6], "sw_version": d[7], "hw_version": d[8],
                               "signal": round(100 * int(d[9]) / 255), "low_battery": d[10], "created": d[11], "updated": d[12], "name": d[13]}
-                    channels = []
-                    query_channel = "SELECT id, name, endpoint_id, type, status, config ,zone_id, zone_status, created, updated, favorite,notification,room_id, device_id from channels where device_id='{}';".format(
-                        d[0])
-                    for c in self.execute(query_channel).fetchall():
-                        channel = {"id": c[0], "name": c[1], "endpoint": c[2], "type": c[3], "status": json.loads(c[4]), "config": c[5], "zone_id": c[6], "zone_status": c[7],
-                                   "created": c[8], "updated": c[9], "favorite": bool(c[10]), "notification": c[11], "room_id": c[12], "device_id": c[13]}
-                        channels.append(channel)
-                    device['channels'] = channels
+                    device['channels'] = device_channels.get(d[0], [])
                     devices.append(device)
                 return devices
             if id:
                 query_device = """SELECT id, ieee, addr, type, model, manufacturer, serial_number, sw_version, hw_version,
-								 lqi, low_battery, created, updated, name from devices where id='{}';""".format(id)
-                d = self.execute(query_device).fetchone()
+								 lqi, low_battery, created, updated, name from devices where id=?;"""
+                d = self.execute(query_device, (id,)).fetchone()
                 device = {"id": d[0], "ieee": d[1], "addr": d[2], "type": d[3], "model": d[4], "manufacturer": d[5], "serial_number": d[6], "sw_version": d[7],
                           "hw_version": d[8], "signal": round(100 * int(d[9]) / 255), "low_battery": d[10], "created": d[11], "updated": d[12], "name": d[13]}
 
                 channels = []
-                query_channel = "SELECT id, name, endpoint_id, type, status, config, zone_id, zone_status, created, updated, favorite,notification,room_id, device_id from channels where device_id='{}';".format(
-                    id)
-                for c in self.execute(query_channel).fetchall():
+                query_channel = "SELECT id, name, endpoint_id, type, status, config, zone_id, zone_status, created, updated, favorite,notification,room_id, device_id from channels where device_id=?;"
+                for c in self.execute(query_channel, (id,)).fetchall():
                     channel = {"id": c[0], "name": c[1], "endpoint": c[2], "type": c[3], "status": json.loads(c[4]), "config": c[5], "zone_id": c[6], "zone_status": c[7],
                                "created": c[8], "updated": c[9], "favorite": bool(c[10]), "notification": c[11], "room_id": c[12], "device_id": c[13]}
                     channels.append(channel)
@@ -930,7 +1022,7 @@ class DbInterface(object):
             self._remove("user_access", "channel_id", channel[0])
             self.remove_channel_in_rule(channel[0])
             number_enpoint = self.execute(
-                "select count(id) from channels where device_id='{}';".format(channel[18])).fetchone()
+                "select count(id) from channels where device_id=?;", (channel[18],)).fetchone()
             if number_enpoint[0] == 1:
                 self._remove("channels", "id", channel[0])
                 self._remove("devices", "id", channel[18])
@@ -943,26 +1035,26 @@ class DbInterface(object):
     ####### CHANNEL ##########
 
     def get_channel(self, all=False, id=False):
-        self._db.row_factory = lambda c, r: dict([(column[0], r[idx]) for idx, column in enumerate(c.description)])
         try:
             if all:
                query_all = """SELECT id, name, enpoint_id, type, status,config ,zone_id,zone_status, created, updated, favorite, device_id from channels;"""
-               return self.execute(query_all)
+               return self._dict_rows(self.execute(query_all))
             if id:
                query_all = """SELECT id, name, enpoint_id, type, status , config, zone_id, zone_status created, updated, favorite, device_id from channels where id=?;"""
-               return self.execute(query_all, id)
+               return self._dict_rows(self.execute(query_all, id))
         except Exception as e:
               LOGGER.error("Get channel error : %s", e)
 
     def get_channel_by_ieee(self, ieee, endpoint_id):
-        return self.execute("SELECT id,type,status,name,notification,room_id,zone_status FROM channels where ieee='{}' and endpoint_id='{}';".format(ieee, endpoint_id)).fetchone()
+        c = self._cached_channel(ieee, endpoint_id)
+        if c:
+            return (c["id"], c["type"], c["status_json"], c["name"], c["notification"], c["room_id"], c["zone_status"])
 
     def update_channel_mqtt(self, channel_id, status):
         try:
-            query_update_channel = "UPDATE channels SET status='{}',updated='{}' WHERE id='{}';".format(
-                json.dumps(status_old), timer, channel_id)
-            self.execute(query_update_channel)
-            self._db.commit()
+            query_update_channel = "UPDATE channels SET status=?,updated=? WHERE id=?;"
+            self.execute(query_update_channel, (json.dumps(status_old), timer, channel_id))
+            self._written("channels", channel_id)
         except Exception as e:
                LOGGER.error("UPDATE channel mqtt % ",e)
                return False
@@ -971,10 +1063,10 @@ class DbInterface(object):
         channel = self._fetchone("channels", "id", channel_id)
         if channel:
            try:
-               self.execute("""update channels set name='{}',status='{}',zone_status='{}',favorite='{}',notification='{}',
-                            room_id='{}' where id='{}';""".format(data['name'],json.dumps(data['status']),data['zone_status'],int(data['favorite']),
-                                                                 data['notification'],data['room_id'],channel_id))
-               self._db.commit()
+               self.execute("""update channels set name=?,status=?,zone_status=?,favorite=?,notification=?,
+                            room_id=? where id=?;""", (data['name'], json.dumps(data['status']), data['zone_status'], int(data['favorite']),
+                                                        data['notification'], data['room_id'], channel_id))
+               self._written("channels", channel_id)
                return
            except Exception as e:
                   LOGGER.error("UPDATE channel info : %s", e)
@@ -989,18 +1081,16 @@ class DbInterface(object):
             data = {}
             channel_status = self.generate_channel_value(channel[1], status)
             timer = int(time.time())
-            query_update_channel = "UPDATE channels SET status='{}',updated='{}' WHERE id='{}';".format(json.dumps(channel_status), timer, channel[0])
-            self.execute(query_update_channel)
-            self._db.commit()
+            self._write_channel_status(channel[0], channel_status, timer, durable=True)
             data["notifi"] = False
             if rule_state == 1 and channel[6] == 1:
-                room_name = self._fetchone("rooms", "id", channel[5])
+                room_name = self._room(channel[5])
                 # self,user_id,id,type_noti,type,name,status,room_name
                 notifi = self.add_notifi("", channel[0], 1, channel[1], channel[3], channel_status, room_name[1])
                 data["notifi"] = notifi
                 LOGGER.debug("Notifi rule alarm")
             elif channel[4] == 1:
-                room_name = self._fetchone("rooms", "id", channel[5])
+                room_name = self._room(channel[5])
                 # self,user_id,id,type_noti,type,name,status,room_name
                 notifi = self.add_notifi("", channel[0], 0, channel[1], channel[3], channel_status, room_name[1])
                 data["notifi"] = notifi
@@ -1008,25 +1098,18 @@ class DbInterface(object):
                 pass
 
             data["channel"] = {"id": channel[0],'status': channel_status, 'updated': timer}
-            #door_reminder add sensor
-            if channel[1] == 8:
-                if channel_status[0]['value'] == 1:
-                   self._door_sensor[str(channel[0])]={'id':channel[0],'name':channel[3],'status': channel_status[0]['value'], 'updated': timer,'room_id':channel[5]}
-                else:
-                    del self._door_sensor[str(channel[0])]
-                print("Door sensor ",self._door_sensor)
+            self.rule_engine.channel_updated(channel[0], channel[1], channel_status, timer, channel[3], channel[5])
             return data
         except Exception as e:
             LOGGER.error("Update channel alarm status: %s", e)
 
     def update_channel_normal(self, ieee, endpoint_id, status):
         try:
-           channel = self._fetch_multi(
-               "channels", "ieee", "endpoint_id", ieee, endpoint_id)
-           for c in channel:
-               channel_status = self.generate_channel_value(c[4], status)
-               status_old = json.loads(c[5])
-               if c[4] == 28:
+           c = self._cached_channel(ieee, endpoint_id)
+           if c:
+               channel_status = self.generate_channel_value(c["type"], status)
+               if c["type"] == 28:
+                   status_old = [dict(s) for s in c["status"]]
                    if not status_old:
                        status_old = [{"type": "temperature", "value": int(status.get('temperature', 25))}, {"type": "humidity", "value": int(status.get('humidity', 50))}]
                    elif status.get('name', None) == 'temperature':
@@ -1035,11 +1118,8 @@ class DbInterface(object):
                        status_old[1]['value'] = int(status.get('value', 25))
                    channel_status = status_old
                timer = int(time.time())
-               query_update_channel = "UPDATE channels SET status='{}',updated='{}' WHERE id='{}';".format(
-                   json.dumps(channel_status), timer, c[0])
-               self.execute(query_update_channel)
-               self._db.commit()
-               return {"id": c[0], 'status': channel_status, 'updated': timer}
+               self._write_channel_status(c["id"], channel_status, timer)  # committed with the next group
+               return {"id": c["id"], 'status': channel_status, 'updated': timer}
         except Exception as e:
                LOGGER.error("Update channel error: %s", e)
 
@@ -1114,10 +1194,9 @@ class DbInterface(object):
             notifi = 1
         try:
             list_status = self.generate_channel_value(type, status)
-            query_update_channel = "UPDATE channels SET status='{}',notification='{}' WHERE id='{}';".format(
-                json.dumps(list_status), notifi, channel_id)
-            self.execute(query_update_channel)
-            self._db.commit()
+            query_update_channel = "UPDATE channels SET status=?,notification=? WHERE id=?;"
+            self.execute(query_update_channel, (json.dumps(list_status), notifi, channel_id))
+            self._written("channels", channel_id)
         except Exception as e:
                LOGGER.error("UPDATE status channel error: %s",e)
 
@@ -1132,6 +1211,7 @@ class DbInterface(object):
             name = LIST_TYPE_CHANNEL_BRAND[model]
             self.execute(query_update_channel,
                          (NAME_TYPE_CHANNEL[name], LIST_TYPE_CHANNEL_BRAND[model], room_id, channel_id))
+            self._written("channels", channel_id)
             return LIST_TYPE_CHANNEL_BRAND[model]
         except Exception as e:
                LOGGER.error("UPDATE status channel error: %s",e)
@@ -1182,7 +1262,7 @@ class DbInterface(object):
     def group_member_removed(self, group, ep):
         q = """DELETE FROM group_members WHERE group_id=?AND addr=?AND endpoint_id=?"""
         self.execute(q, (group.group_id, *ep.unique_id))
-        self._db.commit()
+        self.commit()
 
     ####### NOTIFICATION ##########
     def get_all_notifi(self):
@@ -1192,12 +1272,45 @@ class DbInterface(object):
                                      "title": n[3], "body": n[4], "created": n[5]})
         return list
 
+    def get_notifi(self, since=None, limit=NOTIFICATION_PAGE):
+        '''Notifications added after cursor since, oldest first, at most limit.
+        Without since, the latest limit notifications.
+        Return (notifications, cursor), pass cursor as since for the next fetch.
+        limit is clamped to 1..NOTIFICATION_PAGE, an invalid since fetches the latest.'''
+        try:
+            limit = min(max(int(limit), 1), NOTIFICATION_PAGE)
+        except (TypeError, ValueError):
+            limit = NOTIFICATION_PAGE
+        if since is not None:
+            try:
+                since = int(since)
+            except (TypeError, ValueError):
+                since = None
+        if since is None:
+            rows = self.execute("SELECT rowid,* FROM notification ORDER BY rowid DESC LIMIT ?;", (limit,)).fetchall()
+            rows.reverse()
+        else:
+            rows = self.execute("SELECT rowid,* FROM notification WHERE rowid>? ORDER BY rowid LIMIT ?;", (since, limit)).fetchall()
+        notifications = [{"id": n[1], "user_id": n[2], "type": n[3], "title": n[4], "body": n[5], "created": n[6]}
+                         for n in rows]
+        return notifications, rows[-1][0] if rows else since
+
     def delete_notifi(self, id):
-        self._remove("notification", id)
+        if self._remove("notification", "id", id):
+            self._notifi_count -= 1
 
     def clear_notifi(self):
-        query = "DELETE from notification where id not in ( SELECT id FROM notification ORDER BY created DESC LIMIT 200);"
-        self.execute(query)
+        '''Keep the NOTIFICATION_MAX latest notifications, rowids may have gaps'''
+        query = "DELETE FROM notification WHERE rowid <= (SELECT rowid FROM notification ORDER BY rowid DESC LIMIT 1 OFFSET ?);"
+        self.execute(query, (NOTIFICATION_MAX,))
+        self._notifi_count = min(self._notifi_count, NOTIFICATION_MAX)
+
+    def _notifi_added(self):
+        '''Count a new notification, trim once NOTIFICATION_SLACK over the limit:
+        one delete every NOTIFICATION_SLACK inserts keeps retention O(1) amortized'''
+        self._notifi_count += 1
+        if self._notifi_count > NOTIFICATION_MAX + NOTIFICATION_SLACK:
+            self.clear_notifi()
 
     def add_notifi(self, user_id, id, type_noti, type, name, status, room_name):
         ''' Create notification format
@@ -1225,16 +1338,18 @@ class DbInterface(object):
         id = str(uuid.uuid4())
         timer = int(time.time())
         noti_id = self._add_new("notification", "id,user_id,type,title,body,created", (
-            id, user_id, type_noti, name, json.dumps(data), timer))
+            id, user_id, type_noti, name, json.dumps(data), timer), durable=True)
         if noti_id:
+            self._notifi_added()
             noti = {"id": id, "user_id": user_id, "type": type_noti,
                     "title": name, "body": data, "created": timer}
             return noti
     def add_door_bell_noti(self):
-        d = str(uuid.uuid4())
+        id = str(uuid.uuid4())
         timer = int(time.time())
         noti_id = self._add_new("notification", "id,user_id,type,title,body,created", (id, " ",4,"Chuông cửa", "Chuông cửa đang gọi", timer))
         if noti_id:
+            self._notifi_added()
             noti = {"id": id, "user_id": "", "type": 4,"title": "Chuông cửa", "body": "Chuông cửa đang gọi", "created": timer}
             return noti
     ##### Camera #####
@@ -1254,10 +1369,11 @@ class DbInterface(object):
 
     def update_camera(self, id, data):
         try:
-            query = """UPDATE cameras SET name='{}',roomId='{}',cameraIp='{}',cameraInfo='{}',
-                       streamUri='{}',snapshotUri='{}',update='{}' WHERE id='{}';""".format(name, room_id, camera_ip, camera_info, camera_uri)
-            self.execute(query)
-            self._db.commit()
+            query = """UPDATE cameras SET name=?,roomId=?,cameraIp=?,cameraInfo=?,
+                       streamUri=?,snapshotUri=?,updated=? WHERE id=?;"""
+            self.execute(query, (data['name'], data['roomId'], json.dumps(data['cameraIp']), json.dumps(data['cameraInfo']),
+                                 json.dumps(data['streamUri']), json.dumps(data['snapshotUri']), int(time.time()), id))
+            self.commit()
             return self.get_camera(id=data['id'])
         except Exception as e:
                LOGGER.debug('UPDATE camera error : %s',e)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Database writer
+#
+# Copyright (c) 2020 Ivan , Dicom R&D
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+import os
+import sqlite3
+import threading
+import queue
+import logging
+import collections
+import concurrent.futures
+from time import monotonic
+
+LOGGER = logging.getLogger("Database")
+GROUP_COMMIT_DELAY = 0.05  # max seconds a write waits for its commit
+GROUP_COMMIT_SIZE = 200  # max statements in one commit
+STATEMENT_CACHE = 256  # prepared statements kept per connection
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+
+WriteResult = collections.namedtuple("WriteResult", "lastrowid rowcount")
+
+
+def is_write(query):
+    words = query.split(None, 1)
+    return bool(words) and words[0].upper() in WRITE_STATEMENTS
+
+
+class DbWriter(object):
+    """One thread owning the write connection (WAL mode).
+    Queued statements are committed in groups, every GROUP_COMMIT_DELAY
+    seconds or GROUP_COMMIT_SIZE statements.
+    A durable statement is committed at once with a synced WAL.
+    """
+
+    def __init__(self, database, delay=GROUP_COMMIT_DELAY, size=GROUP_COMMIT_SIZE):
+        self.database = database
+        self.delay = delay
+        self.size = size
+        self._queue = queue.Queue()
+        self._commits = 0
+        self._statements = 0
+        self._write_db = self._connect()  # set WAL mode before any reader connects
+        self._thread = threading.Thread(target=self._run, name="Database-Writer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def execute(self, query, params=(), durable=False, many=False):
+        """Queue a statement, return a Future of its WriteResult set once committed"""
+        future = concurrent.futures.Future()
+        self._queue.put((query, params, durable, many, future))
+        return future
+
+    def executemany(self, query, params, durable=False):
+        return self.execute(query, params, durable, many=True)
+
+    def flush(self, timeout=None):
+        """Wait until every statement queued before is committed"""
+        future = concurrent.futures.Future()
+        self._queue.put((None, None, False, False, future))
+        return future.result(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def metrics(self):
+        return {"queue": self._queue.qsize(),
+                "commits": self._commits,
+                "statements": self._statements}
+
+    def _connect(self):
+        db = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None,
+                             cached_statements=STATEMENT_CACHE)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _sync_wal(self):
+        """fsync the WAL as synchronous=FULL would, pragma can't change inside a transaction"""
+        fd = os.open(self.database + "-wal", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        db = self._write_db
+        cursor = db.cursor()
+        closing = False
+        while not closing:
+            op = self._queue.get()
+            if op is None:
+                break
+            done = []
+            durable = False
+            deadline = monotonic() + self.delay
+            db.execute("BEGIN")
+            while True:
+                query, params, op_durable, many, future = op
+                if query is not None:
+                    try:
+                        if many:
+                            cursor.executemany(query, params)
+                        else:
+                            cursor.execute(query, params)
+                        done.append((future, WriteResult(cursor.lastrowid, cursor.rowcount)))
+                        self._statements += 1
+                    except Exception as e:
+                        LOGGER.error("Write error %s : %s", query, e)
+                        future.set_exception(e)
+                else:
+                    done.append((future, None))
+                durable = durable or op_durable
+                if durable or query is None or len(done) >= self.size:
+                    break
+                try:
+                    op = self._queue.get(timeout=max(0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if op is None:
+                    closing = True
+                    break
+            try:
+                db.execute("COMMIT")
+                if durable:
+                    self._sync_wal()
+                self._commits += 1
+            except Exception as e:
+                LOGGER.error("Commit error : %s", e)
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                for future, result in done:
+                    future.set_exception(e)
+                continue
+            for future, result in done:
+                future.set_result(result)
+        db.close()
+
+
+class ReadConnections(threading.local):
+    """Read only connection per thread"""
+
+    def __init__(self, database):
+        self.db = sqlite3.connect("file:{}?mode=ro".format(database), uri=True,
+                                  check_same_thread=False, cached_statements=STATEMENT_CACHE)
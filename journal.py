@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import os
+import json
+import threading
+import collections
+import logging
+import traceback
+from .scheduler import SCHEDULER
+
+LOGGER = logging.getLogger('zigate')
+
+JOURNAL_FLUSH = 2  # seconds between journal writes
+
+
+def atomic_write(path, data, mode='w'):
+    '''
+    write data to path without ever leaving a partial file:
+    temp file, fsync, rename
+    '''
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, mode) as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:  # not supported on this platform
+        pass
+
+
+class Journal(object):
+    '''
+    Append only journal of state changes, one json record per line.
+    Records with the same key are coalesced until the next flush,
+    so a record must hold the whole state of its key.
+    '''
+    def __init__(self, path, encoder=None, flush_interval=JOURNAL_FLUSH):
+        self.path = path
+        self.encoder = encoder
+        self.flush_interval = flush_interval
+        self._pending = collections.OrderedDict()  # key: record
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def rotated_path(self):
+        return self.path + '.1'
+
+    def append(self, key, record):
+        '''
+        queue record, written in at most flush_interval seconds
+        '''
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = record
+            if self._timer is None:
+                self._timer = SCHEDULER.schedule(self.flush_interval, self.flush)
+
+    def flush(self):
+        '''
+        write pending records and sync them to disk
+        '''
+        with self._lock:
+            self._timer = None
+            if not self._pending:
+                return
+            pending = list(self._pending.items())
+            self._pending.clear()
+            lines = []
+            for key, record in pending:
+                try:
+                    lines.append(json.dumps(record, cls=self.encoder) + '\n')
+                except RuntimeError:  # live object changed while encoding, retry later
+                    self._pending[key] = record
+                except Exception:
+                    LOGGER.error('Failed to encode journal record %s', key)
+                    LOGGER.error(traceback.format_exc())
+            if self._pending:
+                self._timer = SCHEDULER.schedule(self.flush_interval, self.flush)
+            if not lines:
+                return
+            try:
+                with open(self.path, 'a') as fp:
+                    fp.write(''.join(lines))
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            except Exception:
+                LOGGER.error('Failed to write journal %s', self.path)
+                LOGGER.error(traceback.format_exc())
+
+    def rotate(self):
+        '''
+        flush and move current journal aside before a snapshot,
+        changes made while the snapshot is written go to a new journal.
+        A rotated journal left by a failed snapshot is kept,
+        current journal is appended to it.
+        '''
+        self.flush()
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            if not os.path.exists(self.rotated_path):
+                os.replace(self.path, self.rotated_path)
+                return
+            with open(self.path, 'rb') as src:
+                data = src.read()
+            with open(self.rotated_path, 'ab+') as fp:
+                if fp.tell():
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':  # incomplete record, keep it apart
+                        fp.write(b'\n')
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.remove(self.path)
+
+    def discard_rotated(self):
+        '''
+        remove rotated journal once the snapshot is safely written
+        '''
+        try:
+            os.remove(self.rotated_path)
+        except OSError:
+            pass
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def records(self):
+        '''
+        iterate over records of rotated then current journal,
+        an incomplete last line (crash during write) is ignored
+        '''
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as fp:
+                for line in fp:
+                    if not line.endswith('\n'):
+                        LOGGER.warning('Ignore incomplete journal record in %s', path)
+                        break
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        LOGGER.warning('Ignore corrupted journal record in %s', path)
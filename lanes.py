@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+from time import monotonic
+
+LANE_INTERACTIVE = 0  # actions on devices (onoff, level, color...)
+LANE_SECURITY = 1  # IAS
+LANE_CONFIG = 2  # discovery and configuration
+LANE_BULK = 3  # OTA
+LANES = ('interactive', 'security', 'config', 'bulk')
+
+# (first cmd, last cmd, lane), commands not listed are in LANE_CONFIG
+COMMAND_LANES = [(0x0070, 0x0071, LANE_INTERACTIVE),  # identify
+                 (0x0080, 0x00ff, LANE_INTERACTIVE),
+                 (0x0111, 0x0112, LANE_SECURITY),  # IAS warning, squawk
+                 (0x0400, 0x040f, LANE_SECURITY),  # IAS enroll, zone and warning settings
+                 (0x0500, 0x05ff, LANE_BULK),  # OTA
+                 ]
+
+
+def command_lane(cmd):
+    '''
+    return lane of command
+    '''
+    for first, last, lane in COMMAND_LANES:
+        if first <= cmd <= last:
+            return lane
+    return LANE_CONFIG
+
+
+class PriorityWindow(object):
+    '''
+    Window of credits given to waiters by lane priority,
+    lower lane first, FIFO within a lane
+    '''
+    def __init__(self, size, lanes=LANES):
+        self.size = size
+        self.lanes = lanes
+        self._available = size
+        self._cond = threading.Condition()
+        self._waiting = [[] for lane in lanes]
+        self._count = [0] * len(lanes)
+        self._wait_time = [0.0] * len(lanes)
+        self._max_wait_time = [0.0] * len(lanes)
+
+    def resize(self, size):
+        with self._cond:
+            self._available += size - self.size
+            self.size = size
+            self._cond.notify_all()
+
+    def _first(self):
+        for waiting in self._waiting:
+            if waiting:
+                return waiting[0]
+
+    def _take(self, ticket):
+        if self._available > 0 and self._first() is ticket:
+            self._available -= 1
+            return True
+        return False
+
+    def acquire(self, lane, timeout=None, poll=None, on_poll=None):
+        '''
+        wait for a credit, return False after timeout
+        on_poll is called every poll seconds while waiting, without lock held
+        '''
+        ticket = object()
+        t1 = monotonic()
+        with self._cond:
+            self._waiting[lane].append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._take(ticket):
+                        return True
+                    wait = poll
+                    if timeout is not None:
+                        remaining = timeout - (monotonic() - t1)
+                        if remaining <= 0:
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+                    if self._take(ticket):
+                        return True
+                if on_poll:
+                    on_poll()
+        finally:
+            wait_time = monotonic() - t1
+            with self._cond:
+                self._waiting[lane].remove(ticket)
+                self._count[lane] += 1
+                self._wait_time[lane] += wait_time
+                if wait_time > self._max_wait_time[lane]:
+                    self._max_wait_time[lane] = wait_time
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._available += 1
+            self._cond.notify_all()
+
+    def metrics(self):
+        '''
+        return queue depth and wait time per lane
+        '''
+        with self._cond:
+            metrics = {'size': self.size,
+                       'available': self._available}
+            for i, name in enumerate(self.lanes):
+                count = self._count[i]
+                metrics[name] = {'depth': len(self._waiting[i]),
+                                 'count': count,
+                                 'avg_wait_time': self._wait_time[i] / count if count else 0.0,
+                                 'max_wait_time': self._max_wait_time[i]}
+            return metrics
@@ -0,0 +1,115 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+
+RAW = object()  # placeholder of values not yet loaded
+
+
+class LazyDict(dict):
+    '''
+    dict keeping some values as raw data,
+    loader converts raw data to value on first access.
+    Keys, len and membership never load values,
+    values() and items() load everything.
+    '''
+    def __init__(self, loader):
+        dict.__init__(self)
+        self._loader = loader
+        self._raw = {}
+        self._lock = threading.RLock()
+
+    def set_raw(self, key, data):
+        with self._lock:
+            self._raw[key] = data
+            dict.__setitem__(self, key, RAW)
+
+    def raw(self, key):
+        '''
+        return raw data of key if not yet loaded
+        '''
+        return self._raw.get(key)
+
+    def raw_count(self):
+        return len(self._raw)
+
+    def _load(self, key):
+        with self._lock:
+            value = dict.__getitem__(self, key)
+            if value is not RAW:  # loaded by another thread
+                return value
+            data = self._raw.pop(key)
+            try:
+                value = self._loader(data)
+            except Exception:
+                dict.__delitem__(self, key)
+                raise KeyError(key)
+            dict.__setitem__(self, key, value)
+            return value
+
+    def load_next(self):
+        '''
+        load one raw value, return False if nothing left
+        '''
+        try:
+            key = next(iter(self._raw))
+        except (StopIteration, RuntimeError):  # empty or changed during iteration
+            return bool(self._raw)
+        try:
+            self._load(key)
+        except KeyError:
+            pass
+        return True
+
+    def load_all(self):
+        while self.load_next():
+            pass
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is RAW:
+            value = self._load(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._raw.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._raw.pop(key, None)
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._raw.clear()
+            dict.clear(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
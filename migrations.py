@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Database migrations
+#
+# Copyright (c) 2020 Ivan , Dicom R&D
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+import re
+import sys
+import sqlite3
+import logging
+
+LOGGER = logging.getLogger("Database")
+
+# (version, description, statements) applied in order to databases with a lower user_version
+MIGRATIONS = [
+    (2, "secondary indexes for hot queries", (
+        "CREATE INDEX IF NOT EXISTS channels_id_idx ON channels(id)",
+        "CREATE INDEX IF NOT EXISTS channels_device_idx ON channels(device_id)",
+        "CREATE INDEX IF NOT EXISTS attributes_cluster_idx ON attributes(ieee, cluster)",
+        "CREATE INDEX IF NOT EXISTS notification_created_idx ON notification(created)",
+        "CREATE INDEX IF NOT EXISTS rules_type_idx ON rules(type)",
+        # unique on id allowed a single channel per rule
+        "DROP INDEX IF EXISTS condition_alarm_mode_idx",
+        "CREATE UNIQUE INDEX condition_alarm_mode_idx ON condition_alarm_mode(id, channel_id)",
+        "DROP INDEX IF EXISTS conditions_bind_channel_idx",
+        "CREATE UNIQUE INDEX conditions_bind_channel_idx ON conditions_bind_channel(id, channel_id)",
+        "DROP INDEX IF EXISTS action_channelsx",
+        "CREATE UNIQUE INDEX action_channelsx ON action_channels(id, channel_id)",
+    )),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# queries run on each sensor report or rule/device load, none may scan a whole table
+HOT_QUERIES = (
+    "UPDATE channels SET status=?,updated=? WHERE id=?",
+    "SELECT id,type,status,name,notification,room_id,zone_status FROM channels where ieee=? and endpoint_id=?",
+    "SELECT * FROM channels WHERE id=?",
+    "SELECT * FROM channels WHERE device_id=?",
+    "SELECT * FROM attributes WHERE ieee=? and cluster=?",
+    "SELECT * FROM rooms WHERE id=?",
+    "SELECT id,type,status FROM rules WHERE type=?",
+    "SELECT max(status) FROM rules WHERE type IN (1, 3)",
+    "SELECT t.* FROM conditions t JOIN rules r ON r.id = t.id WHERE r.id=? ORDER BY t.rowid",
+    "SELECT t.* FROM condition_alarm_mode t JOIN rules r ON r.id = t.id WHERE r.id=? ORDER BY t.rowid",
+    "SELECT t.* FROM conditions_bind_channel t JOIN rules r ON r.id = t.id WHERE r.id=? ORDER BY t.rowid",
+    "SELECT t.* FROM actions t JOIN rules r ON r.id = t.id WHERE r.id=? ORDER BY t.rowid",
+    "SELECT t.* FROM action_channels t JOIN rules r ON r.id = t.id WHERE r.id=? ORDER BY t.rowid",
+    "DELETE FROM notification WHERE rowid <= (SELECT rowid FROM notification ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+    "SELECT rowid,* FROM notification WHERE rowid>? ORDER BY rowid LIMIT ?",
+)
+BOUNDED_WALK = re.compile(r"ORDER BY rowid DESC LIMIT ", re.IGNORECASE)  # walk from the last row
+
+
+def migrate(database):
+    """Apply migrations newer than the database user_version, return its version"""
+    db = sqlite3.connect(database, isolation_level=None)
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            LOGGER.info("Migrate database to version %s : %s", number, description)
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for statement in statements:
+                    db.execute(statement)
+                db.execute("PRAGMA user_version = {}".format(number))
+                db.execute("COMMIT")
+            except sqlite3.Error as e:
+                LOGGER.error("Migration to version %s failed : %s", number, e)
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                break
+            version = number
+        for query, detail in full_scans(db):
+            LOGGER.warning("Full table scan (%s) : %s", detail, query)
+        return version
+    finally:
+        db.close()
+
+
+def full_scans(db):
+    """Hot queries whose plan scans a whole table, as (query, plan detail)"""
+    scans = []
+    for query in HOT_QUERIES:
+        if BOUNDED_WALK.search(query):
+            continue  # planner shows a scan, it stops after LIMIT + OFFSET rows
+        for row in db.execute("EXPLAIN QUERY PLAN " + query, (None,) * query.count("?")):
+            detail = row[-1]
+            if detail.startswith("SCAN") and " INDEX " not in detail:
+                scans.append((query, detail))
+    return scans
+
+
+def main():
+    """Migrate database then check hot query plans, exit 1 on full table scan"""
+    if len(sys.argv) > 1:
+        database = sys.argv[1]
+    else:
+        from .config import DATABASE
+        database = DATABASE
+    version = migrate(database)
+    db = sqlite3.connect(database)
+    scans = full_scans(db)
+    db.close()
+    print("Schema version {}".format(version))
+    for query, detail in scans:
+        print("Full table scan ({}) : {}".format(detail, query))
+    sys.exit(1 if scans else 0)
+
+
+if __name__ == '__main__':
+    main()
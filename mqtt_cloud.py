@@ -10,6 +10,7 @@ import json
 import ssl
 from .config import (CA_CLOUD,CLIENT_CLOUD_CRT,CLIENT_CLOUD_KEY,MQTT_CLOUD_HOST,MQTT_CLOUD_PORT,MAIN_CLOUD_TOPIC)
 from .config_manager import ConfigManager
+from .dbsync import dumps_response, NOTIFICATION_PAGE
 class MQTT_Broker(object):
 
     def __init__(self,zigate,db):
@@ -89,7 +90,7 @@ class MQTT_Broker(object):
                   "value":value
                 }
         print('Publish {}'.format(topics))
-        self.client.publish(topics,json.dumps(data), retain=False)
+        self.client.publish(topics,dumps_response(data), retain=False)
     def _publish_data_init(self):
         '''
         Publish data init when startup
@@ -97,7 +98,7 @@ class MQTT_Broker(object):
         self._publish_response("user","join","user_id",{"user_id":self.db.get_all_user_id()})
         ip = ConfigManager().cmd('/etc/dhome/network/check_ip_local')
         self.db.update_homegate_info("ip_local",str(ip),self.hg['id'])
-        self._publish_response("reload","update","all",self.db.update_total_homegate_db())
+        self._publish_response("reload","update","all",self.db.reload_snapshot())
 
     def device_added(self,device):
         print(device)
@@ -141,7 +142,7 @@ class MQTT_Broker(object):
                 ip = ConfigManager().get_ip_local()
                 if ip:
                    self.db.update_homegate_info("ip_local",str(ip),self.hg['id'])
-                self._publish_response("reload","update","all",self.db.update_total_homegate_db())
+                self._publish_response("reload","update","all",self.db.reload_snapshot())
             except Exception as e:
                    print(e)
             self._publish_response("user","join","user_id",{"user_id":self.db.get_all_user_id()})
@@ -184,7 +185,7 @@ class MQTT_Broker(object):
         print(data['action'])
         if data['action'] == 'get':
            if data['type'] == 'id':
-              data = self.db.update_total_homegate_db()
+              data = self.db.reload_snapshot()
               if data:
                  self._publish_response("homegate","update","id",data)
         elif data['action'] == 'get' and data['type'] =='info':
@@ -304,10 +305,16 @@ class MQTT_Broker(object):
              data_camera = self.db.get_camera(all=True)
              self._publish_response("camera","get","all",data_camera)
 
-    def notifi_respone(self,data,user,token):
+    def notifi_respone(self,data):
         if data['action'] == "get" and data['type'] == "all":
            noti = self.db.get_all_notifi()
            self._publish_response("rules","update","status",{"notification":noti})
+        elif data['action'] == "get" and data['type'] == "since":
+           value = data.get('value')
+           if not isinstance(value, dict):
+               value = {}
+           noti, cursor = self.db.get_notifi(value.get('since'), value.get('limit', NOTIFICATION_PAGE))
+           self._publish_response("notification","get","since",{"notification":noti,"cursor":cursor})
     def door_bell_call(self):
         data = self.db.add_door_bell_noti()
         self._publish_response("notification","add","channel",data)
@@ -11,6 +11,7 @@ import ssl
 from .config import (CA_LOCAL, CLIENT_LOCAL_CRT, CLIENT_LOCAL_KEY, MQTT_LOCAL_HOST,
                      MQTT_LOCAL_USERNAME, MQTT_LOCAL_PORT, MAIN_LOCAL_TOPIC, APP_ID, USER_ID_INIT, TOKEN_INIT)
 from .config_manager import ConfigManager
+from .dbsync import dumps_response, NOTIFICATION_PAGE
 import time
 import logging
 LOGGER = logging.getLogger("MQTT_LOCAL")
@@ -105,7 +106,7 @@ class MQTT_Broker(object):
                     "value": value
                     }
             LOGGER.debug('Publish data %s',topics)
-            self.client.publish(topics, json.dumps(data), retain=False)
+            self.client.publish(topics, dumps_response(data), retain=False)
         else:
             for user in self.user:
                 if user[5] == 1:
@@ -117,7 +118,7 @@ class MQTT_Broker(object):
                             "value": value
                             }
                     LOGGER.debug('Publish data %s',topics)
-                    self.client.publish(topics, json.dumps(data), retain=False)
+                    self.client.publish(topics, dumps_response(data), retain=False)
                 else:
                     limit_user = self.db.check_user_access_channle(
                         user[0], channel_id)
@@ -131,7 +132,7 @@ class MQTT_Broker(object):
                                 }
                         LOGGER.debug('Publish data %s',topics)
                         self.client.publish(
-                            topics, json.dumps(data), retain=False)
+                            topics, dumps_response(data), retain=False)
 
     def _publish_response_default(self, topic, action, type, value):
         '''
@@ -163,7 +164,7 @@ class MQTT_Broker(object):
         '''
         Publish data init when startup
         '''
-        self._publish_response("reload","update","all",self.db.update_total_homegate_db())
+        self._publish_response("reload","update","all",self.db.reload_snapshot())
 
     def device_added(self, device):
         self._publish_response("device", "add", "add_new", device)
@@ -319,7 +320,7 @@ class MQTT_Broker(object):
     def homegate_response(self, data, user, token):
         if data['action'] == 'get':
             if data['type'] == 'id':
-                data = self.db.update_total_homegate_db()
+                data = self.db.reload_snapshot()
                 if data:
                     self._publish_response(
                         "homegate", "update", "id", data, user_id=user, access_token=token)
@@ -459,6 +460,13 @@ class MQTT_Broker(object):
             noti = self.db.get_all_notifi()
             self._publish_response("rules", "update", "status", {
                                    "notification": noti}, user_id=user, access_token=token)
+        elif data['action'] == "get" and data['type'] == "since":
+            value = data.get('value')
+            if not isinstance(value, dict):
+                value = {}
+            noti, cursor = self.db.get_notifi(value.get('since'), value.get('limit', NOTIFICATION_PAGE))
+            self._publish_response("notification", "get", "since", {
+                                   "notification": noti, "cursor": cursor}, user_id=user, access_token=token)
     def doorbell_response(self):
         self.zigate._call_door_bell()
     def room_response(self):
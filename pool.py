@@ -0,0 +1,101 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+import queue
+import logging
+import traceback
+
+LOGGER = logging.getLogger('zigate')
+
+
+class ShardedWorkerPool(object):
+    '''
+    Fixed size pool of worker threads, one queue per worker.
+    Tasks submitted with the same key always run on the same worker,
+    so they are processed in submission order.
+    '''
+    def __init__(self, size=4, name='ZiGate-Worker'):
+        self.size = max(1, int(size))
+        self.name = name
+        self._queues = [queue.Queue() for i in range(self.size)]
+        self._threads = []
+        self._max_depth = [0] * self.size
+        self._processed = [0] * self.size
+
+    @property
+    def running(self):
+        return any(t.is_alive() for t in self._threads)
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.size):
+            t = threading.Thread(target=self._run, args=(index,),
+                                 name='{}-{}'.format(self.name, index))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        '''
+        stop workers once their pending tasks are done
+        '''
+        threads = self._threads
+        self._threads = []
+        for q in self._queues:
+            q.put(None)
+        current = threading.current_thread()
+        for t in threads:
+            if t is not current:
+                t.join(timeout)
+
+    def shard(self, key):
+        return hash(key) % self.size
+
+    def submit(self, key, func, *args):
+        '''
+        queue func(*args) on the worker owning key
+        '''
+        index = self.shard(key)
+        q = self._queues[index]
+        q.put((func, args))
+        depth = q.qsize()
+        if depth > self._max_depth[index]:
+            self._max_depth[index] = depth
+
+    def depth(self):
+        '''
+        total number of pending tasks
+        '''
+        return sum(q.qsize() for q in self._queues)
+
+    def metrics(self):
+        '''
+        return queue depth metrics per worker
+        '''
+        return {'size': self.size,
+                'depth': [q.qsize() for q in self._queues],
+                'max_depth': list(self._max_depth),
+                'processed': list(self._processed)}
+
+    def reset_metrics(self):
+        self._max_depth = [0] * self.size
+
+    def _run(self, index):
+        q = self._queues[index]
+        while True:
+            task = q.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.error('Error in worker %s', index)
+                LOGGER.error(traceback.format_exc())
+            self._processed[index] += 1
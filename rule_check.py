@@ -1,7 +1,13 @@
 from pydispatch import dispatcher
 import threading
+import logging
+import traceback
+import time
 from .dbsync import DbInterface
 
+LOGGER = logging.getLogger("Database")
+
+
 def dispatch_signal(signal=dispatcher.Any, sender=dispatcher.Anonymous,
                     *arguments, **named):
     '''
@@ -14,33 +20,51 @@ def dispatch_signal(signal=dispatcher.Any, sender=dispatcher.Anonymous,
         LOGGER.error('Exception dispatching signal %s', signal)
         LOGGER.error(traceback.format_exc())
 class Rule_Check(object):
-    """docstring forRule_Check."""
+    """Run timer rules and door reminders of the rule engine.
+    One thread sleeps until the next minute or door deadline,
+    an earlier deadline scheduled by a channel update wakes it up."""
 
-    def __init__(self):
-        self._dblistener = DbInterface()
-        # dispatcher.connect(self.door_reminder_status, DOOR_REMINDER_CHECK)
-        self._door_reminder = None
+    def __init__(self, dblistener=None):
+        self._dblistener = dblistener or DbInterface()
+        self._stop = threading.Event()
+        self._thread = None
 
     def start_auto_check_rule(self):
-        '''Automation check one minutes'''
-        print("Check rule automation" ,self._dblistener.check_rule_timer())
-        self._door_reminder = threading.Timer(1, self.start_auto_save)
-        self._door_reminder.setDaemon(True)
-        self._door_reminder.start()
-    def door_reminder_status(self,channel_door):
-        pass
-    def door_reminder_check(self):
-        '''Automation check one minutes'''
-        while 1:
-              print("Check rule automation" ,self._dblistener.check_door_open())
-              self._door_reminder = threading.Timer(10, self.door_reminder_check)
-              self._door_reminder.setDaemon(True)
-              self._door_reminder.start()
+        '''Start checking rules, once'''
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Rule-Check")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    door_reminder_check = start_auto_check_rule
 
+    def _run(self):
+        engine = self._dblistener.rule_engine
+        while not self._stop.is_set():
+            engine.wakeup.wait(max(0, engine.next_event() - time.time()))
+            engine.wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                actions = self._dblistener.check_rule_timer()
+                if actions:
+                    LOGGER.debug("Timer rule actions %s", actions)
+                notifi = self._dblistener.check_door_open()
+                if notifi:
+                    LOGGER.debug("Door reminder %s", notifi)
+            except Exception:
+                LOGGER.error('Exception checking rules')
+                LOGGER.error(traceback.format_exc())
 
     def stop_door_reminder_check(self):
-        if self._door_reminder:
-            self._door_reminder.cancel()
+        self._stop.set()
+        self._dblistener.rule_engine.wakeup.set()
+        if self._thread:
+            self._thread.join()
 if __name__ == '__main__':
     d = Rule_Check()
     d.door_reminder_check()
+    while 1:
+        time.sleep(60)
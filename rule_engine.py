@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# Rule engine
+#
+# Copyright (c) 2020 Ivan , Dicom R&D
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+import time
+import heapq
+import logging
+import threading
+from datetime import datetime
+
+LOGGER = logging.getLogger("Database")
+RULE_DOOR_REMINDER = 5
+CHANNEL_DOOR = 8
+DOOR_OPEN_DELAY = 160  # seconds a door stays open before its reminder
+TIMER_MOMENT = 0
+TIMER_PERIOD = 1
+
+
+def _minutes(value):
+    '''"HH:MM" to minute of day'''
+    if not value:
+        return None
+    hour, minute = value.split(":")
+    return int(hour) * 60 + int(minute)
+
+
+class TimeCondition(object):
+    '''Timer condition of a rule: {"type", "repeat", "value": {"start_time", "end_time"}}
+    repeat days are weekday() + 2, monday is 2'''
+    __slots__ = ("type", "days", "start", "end")
+
+    def __init__(self, timer):
+        value = timer.get("value") or {}
+        self.type = timer.get("type", TIMER_MOMENT)
+        self.days = frozenset(int(d) for d in timer.get("repeat") or ())
+        self.start = _minutes(value.get("start_time"))
+        self.end = _minutes(value.get("end_time"))
+
+    def at(self, now):
+        '''True at start minute on a repeat day'''
+        return now.weekday() + 2 in self.days and now.hour * 60 + now.minute == self.start
+
+    def within(self, now):
+        '''True between start and end minute on a repeat day'''
+        if now.weekday() + 2 not in self.days:
+            return False
+        minute = now.hour * 60 + now.minute
+        return self.start <= minute <= (self.start if self.end is None else self.end)
+
+
+class CompiledRule(object):
+    '''Rule predicate built once from get_rule() dict'''
+    __slots__ = ("id", "name", "type", "status", "timer", "channels", "actions")
+
+    def __init__(self, rule):
+        conditions = rule.get("conditions") or {}
+        actions = rule.get("actions") or {}
+        self.id = rule["id"]
+        self.name = rule["name"]
+        self.type = rule["type"]
+        self.status = rule["status"]
+        timer = conditions.get("timer")
+        self.timer = TimeCondition(timer) if timer else None
+        alarm_mode = conditions.get("alarm_mode") or ()
+        bind = (conditions.get("access_control") or {}).get("bind_channel_ids") or ()
+        self.channels = frozenset([a["channel_id"] for a in alarm_mode if a.get("channel_id")] +
+                                  [b["channel_id"] for b in bind if b.get("channel_id")])
+        self.actions = {"id": self.id, "channels": actions.get("channels") or [],
+                        "notification": actions.get("activate_notification")}
+
+
+class RuleEngine(object):
+    '''Rules compiled from the rules tables, evaluated on events only.
+    Rules are indexed by the channel ids they depend on, moment timers by minute of day.
+    A door sensor update looks up its reminder rules, a clock tick the timers
+    of its minute and the door reminders due. Rules are compiled again once the "rules"
+    version of the database changed.
+    '''
+
+    def __init__(self, db, door_delay=DOOR_OPEN_DELAY):
+        self._db = db
+        self.door_delay = door_delay
+        self._version = None
+        self._rules = {}  # rule id: CompiledRule
+        self._by_channel = {}  # channel id: rules
+        self._by_minute = {}  # minute of day: moment timer rules
+        self._doors = {}  # channel id: open door
+        self._scheduled = set()  # open doors with a deadline
+        self._deadlines = []  # heap of (due, channel id, opened)
+        self._last_minute = None
+        self._lock = threading.RLock()
+        self.wakeup = threading.Event()  # set when an earlier deadline is scheduled
+
+    def _compile(self):
+        version = self._db._versions["rules"]
+        if version == self._version:
+            return
+        self._db.commit()  # writes counted in version are readable
+        rules = {}
+        by_channel = {}
+        by_minute = {}
+        for rule in self._db.get_rule(all=True) or ():
+            try:
+                compiled = CompiledRule(rule)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                LOGGER.error("Compile rule %s error : %s", rule.get("id"), e)
+                continue
+            rules[compiled.id] = compiled
+            for channel_id in compiled.channels:
+                by_channel.setdefault(channel_id, []).append(compiled)
+            timer = compiled.timer
+            if timer and timer.type == TIMER_MOMENT and timer.start is not None and timer.days:
+                by_minute.setdefault(timer.start, []).append(compiled)
+        self._rules, self._by_channel, self._by_minute = rules, by_channel, by_minute
+        self._version = version
+        LOGGER.debug("Compiled %s rules", len(rules))
+        for door in self._doors.values():  # doors opened before a reminder covered them
+            self._schedule(door)
+
+    def _reminders(self, channel_id):
+        return [r for r in self._by_channel.get(channel_id, ()) if r.type == RULE_DOOR_REMINDER]
+
+    def _schedule(self, door):
+        if door["id"] not in self._scheduled and self._reminders(door["id"]):
+            self._scheduled.add(door["id"])
+            due = door["updated"] + self.door_delay
+            if not self._deadlines or due < self._deadlines[0][0]:
+                self.wakeup.set()
+            heapq.heappush(self._deadlines, (due, door["id"], door["updated"]))
+
+    def channel_updated(self, channel_id, channel_type, status, updated, name=None, room_id=None):
+        '''Channel status changed: track door sensors opened or closed'''
+        if channel_type != CHANNEL_DOOR or not status:
+            return
+        with self._lock:
+            self._compile()
+            if status[0]["value"] == 1:
+                if channel_id in self._doors:
+                    return  # still open, keep first opening time
+                door = self._doors[channel_id] = {"id": channel_id, "name": name, "status": status[0]["value"],
+                                                  "updated": updated, "room_id": room_id}
+                self._schedule(door)
+            else:
+                self._doors.pop(channel_id, None)
+                self._scheduled.discard(channel_id)
+
+    def next_event(self, now=None):
+        '''Time of the next tick: next minute or earliest door deadline'''
+        now = time.time() if now is None else now
+        with self._lock:
+            event = now - now % 60 + 60
+            if self._deadlines:
+                event = min(event, self._deadlines[0][0])
+            return event
+
+    def timer_actions(self, now=None):
+        '''Actions of moment timer rules due this minute, once per minute'''
+        now = datetime.now() if now is None else datetime.fromtimestamp(now)
+        minute = (now.date(), now.hour * 60 + now.minute)
+        with self._lock:
+            self._compile()
+            if minute == self._last_minute:
+                return []
+            self._last_minute = minute
+            return [r.actions for r in self._by_minute.get(minute[1], ()) if r.timer.at(now)]
+
+    def doors_due(self, now=None):
+        '''(rule, door) of doors open longer than door_delay, once per opening.
+        A door reminder timer limits reminders to its start..end period.'''
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            self._compile()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, channel_id, opened = heapq.heappop(self._deadlines)
+                door = self._doors.get(channel_id)
+                if door is None or door["updated"] != opened:
+                    continue  # closed since
+                for rule in self._reminders(channel_id):
+                    if rule.timer is None or rule.timer.within(datetime.fromtimestamp(now)):
+                        due.append((rule, door))
+                        break
+        return due
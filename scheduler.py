@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+import heapq
+import itertools
+import logging
+from time import monotonic
+from .pool import ShardedWorkerPool
+
+LOGGER = logging.getLogger('zigate')
+
+
+class ScheduledTask(object):
+    '''
+    Task scheduled by Scheduler, replacement of threading.Timer
+    '''
+    def __init__(self, scheduler, func, args):
+        self._scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.when = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def reschedule(self, delay):
+        '''
+        run task in delay seconds, even if cancelled or already run
+        '''
+        self._scheduler.reschedule(self, delay)
+
+    def __repr__(self):
+        return 'ScheduledTask {} at {}'.format(self.func, self.when)
+
+
+class Scheduler(object):
+    '''
+    One thread running delayed tasks from a heap,
+    tasks are executed by a small worker pool
+    '''
+    def __init__(self, workers=2, name='ZiGate-Scheduler'):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ShardedWorkerPool(workers, name + '-Worker')
+        self._thread = None
+
+    def _start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._pool.start()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def schedule(self, delay, func, *args):
+        '''
+        run func(*args) in delay seconds, return ScheduledTask
+        '''
+        task = ScheduledTask(self, func, args)
+        self.reschedule(task, delay)
+        return task
+
+    def reschedule(self, task, delay):
+        with self._cond:
+            self._start()
+            task.cancelled = False
+            task.when = monotonic() + delay
+            heapq.heappush(self._heap, (task.when, next(self._counter), task))
+            if self._heap[0][2] is task:
+                self._cond.notify()
+
+    def pending(self):
+        '''
+        number of scheduled tasks, including cancelled ones not yet dropped
+        '''
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, count, task = self._heap[0]
+                    if task.cancelled or when != task.when:  # cancelled or rescheduled
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = when - monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    task.when = None
+                    break
+            self._pool.submit(task, task.func, *task.args)
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,164 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+'''
+Compact binary snapshot of ZiGate persistent state
+
+File is MAGIC, format version (unsigned short) then marshal data.
+Attributes are stored with their decoded value,
+so loading doesn't evaluate value expressions again.
+
+Convert from/to json persistent file:
+    python3 -m zigate.snapshot export ~/.zigate.json ~/.zigate.bin
+    python3 -m zigate.snapshot import ~/.zigate.bin ~/.zigate.json
+Check attributes are the same once loaded from json and snapshot:
+    python3 -m zigate.snapshot check ~/.zigate.json
+'''
+
+import os
+import marshal
+import struct
+import shutil
+import logging
+import tempfile
+
+LOGGER = logging.getLogger('zigate')
+
+MAGIC = b'ZGSNAP'
+SNAPSHOT_VERSION = 1
+MARSHAL_VERSION = 4
+HEADER = struct.Struct('!H')
+SNAPSHOT_EXTENSION = '.bin'
+
+
+def is_snapshot(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def _plain(obj, default):
+    '''
+    convert obj to types supported by marshal
+    '''
+    if isinstance(obj, dict):
+        return {k: _plain(v, default) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return type(obj)(_plain(v, default) for v in obj)
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return obj
+    return _plain(default(obj), default)
+
+
+def dumps(data, default=None):
+    '''
+    return binary snapshot of data
+    default converts objects not supported by marshal
+    '''
+    try:
+        payload = marshal.dumps(data, MARSHAL_VERSION)
+    except ValueError:
+        if default is None:
+            raise
+        payload = marshal.dumps(_plain(data, default), MARSHAL_VERSION)
+    return MAGIC + HEADER.pack(SNAPSHOT_VERSION) + payload
+
+
+def loads(data):
+    '''
+    return data from binary snapshot
+    '''
+    if not is_snapshot(data):
+        raise ValueError('Not a ZiGate snapshot')
+    offset = len(MAGIC)
+    version, = HEADER.unpack_from(data, offset)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError('Unsupported snapshot version {}'.format(version))
+    return marshal.loads(data[offset + HEADER.size:])
+
+
+def export_snapshot(json_path, snapshot_path):
+    '''
+    convert json persistent file to binary snapshot
+    '''
+    from .core import ZiGate
+    z = ZiGate(path=json_path, auto_start=False)
+    if not z.load_state():
+        raise ValueError('Failed to load {}'.format(json_path))
+    z.save_state(snapshot_path)
+    return len(z._devices)
+
+
+def import_snapshot(snapshot_path, json_path):
+    '''
+    convert binary snapshot to json persistent file
+    '''
+    from .core import ZiGate
+    z = ZiGate(path=snapshot_path, auto_start=False)
+    if not z.load_state():
+        raise ValueError('Failed to load {}'.format(snapshot_path))
+    z.save_state(json_path)
+    return len(z._devices)
+
+
+def _attributes(z):
+    attributes = {}
+    for device in list(z._devices.values()):
+        for endpoint_id, endpoint in device.endpoints.items():
+            for cluster_id, cluster in endpoint['clusters'].items():
+                for attribute_id, attribute in cluster.attributes.items():
+                    attributes[(device.addr, endpoint_id, cluster_id, attribute_id)] = attribute
+    return attributes
+
+
+def check_snapshot(json_path):
+    '''
+    load json persistent file and its snapshot,
+    return [(key, json attribute, snapshot attribute)] of attributes not the same
+    '''
+    from .core import ZiGate
+    tmp = tempfile.mkdtemp()
+    try:
+        snapshot_path = os.path.join(tmp, 'check' + SNAPSHOT_EXTENSION)
+        export_snapshot(json_path, snapshot_path)
+        loaded = []
+        for path in (json_path, snapshot_path):
+            z = ZiGate(path=path, auto_start=False)
+            if not z.load_state():
+                raise ValueError('Failed to load {}'.format(path))
+            loaded.append(_attributes(z))
+    finally:
+        shutil.rmtree(tmp)
+    from_json, from_snapshot = loaded
+    return [(key, from_json.get(key), from_snapshot.get(key))
+            for key in sorted(set(from_json) | set(from_snapshot))
+            if from_json.get(key) != from_snapshot.get(key)]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert ZiGate persistent file')
+    parser.add_argument('command', choices=['export', 'import', 'check'],
+                        help='export: json to snapshot, import: snapshot to json, '
+                             'check: json and snapshot load the same attributes')
+    parser.add_argument('source')
+    parser.add_argument('destination', nargs='?')
+    args = parser.parse_args()
+    if args.command == 'check':
+        differences = check_snapshot(args.source)
+        for key, json_attribute, snapshot_attribute in differences:
+            print('{} json {} snapshot {}'.format(key, json_attribute, snapshot_attribute))
+        print('{} attributes differ'.format(len(differences)))
+        raise SystemExit(1 if differences else 0)
+    if args.destination is None:
+        parser.error('destination is required')
+    if args.command == 'export':
+        count = export_snapshot(args.source, args.destination)
+    else:
+        count = import_snapshot(args.source, args.destination)
+    print('{} devices converted to {}'.format(count, args.destination))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,14 +8,15 @@
 import threading
 import logging
 import time
+import os
 import serial
-import serial.tools.list_ports
 import queue
 import socket
 import select
 from pydispatch import dispatcher
 import sys
 from .const import ZIGATE_FAILED_TO_CONNECT
+from .codec import (zigate_encode, zigate_decode, checksum, encode_message)
 import struct
 from binascii import unhexlify, hexlify
 
@@ -33,27 +34,37 @@ class ZIGATE_CANNOT_CONNECT(Exception):
 
 class BaseTransport(object):
     def __init__(self):
-        self._buffer = b''
+        self._buffer = bytearray()
         self.queue = queue.Queue()
         self.received = queue.Queue()
 
     def read_data(self, data):
         '''
         Read ZiGate output and split messages
+        complete messages are queued as memoryview of the received chunk,
+        only the unterminated tail is kept in buffer
         '''
-        LOGGER.debug('Raw packet received, {}'.format(data))
-        self._buffer += data
-#         print(self._buffer)
-        endpos = self._buffer.find(b'\x03')
+        LOGGER.debug('Raw packet received, %s', data)
+        endpos = data.find(b'\x03')
+        if endpos == -1:
+            self._buffer += data
+            return
+        if self._buffer:
+            endpos += len(self._buffer)
+            self._buffer += data
+            data = bytes(self._buffer)
+        view = memoryview(data)
+        pos = 0
         while endpos != -1:
-            startpos = self._buffer.rfind(b'\x01', 0, endpos)
-            if startpos != -1 and startpos < endpos:
-                raw_message = self._buffer[startpos:endpos + 1]
-                self.received.put(raw_message)
+            startpos = data.rfind(b'\x01', pos, endpos)
+            if startpos != -1:
+                self.received.put(view[startpos:endpos + 1])
             else:
                 LOGGER.error('Malformed packet received, ignore it')
-            self._buffer = self._buffer[endpos + 1:]
-            endpos = self._buffer.find(b'\x03')
+            pos = endpos + 1
+            endpos = data.find(b'\x03', pos)
+        del self._buffer[:]
+        self._buffer += view[pos:]
 
     def send(self, data):
         self.queue.put(data)
@@ -106,21 +117,12 @@ class FakeTransport(BaseTransport):
     def send(self, data):
         self.sent.append(data)
         # retrieve cmd
-        data = self.zigate_decode(data[1:-1])
+        data = zigate_decode(data[1:-1])
         cmd = struct.unpack('!H', data[0:2])[0]
         # reply 0x8000 ok for cmd
         lqi = 255
         value = struct.pack('!BBHB', 0, 1, cmd, lqi)
-        length = len(value)
-        checksum = self.checksum(struct.pack('!H', 0x8000),
-                                 struct.pack('!B', length),
-                                 value)
-        raw_message = struct.pack('!HHB{}s'.format(len(value)), 0x8000, length, checksum, value)
-        enc_msg = self.zigate_encode(raw_message)
-        enc_msg.insert(0, 0x01)
-        enc_msg.append(0x03)
-        enc_msg = bytes(enc_msg)
-        self.received.put(enc_msg)
+        self.received.put(encode_message(0x8000, value))
 
         data = hexlify(data[5:])
         if (cmd, data) in self.auto_responder:
@@ -136,54 +138,22 @@ class FakeTransport(BaseTransport):
 
     def create_fake_response(self, resp, value, lqi=255):
         value += struct.pack('!B', lqi)
-        length = len(value)
-        checksum = self.checksum(struct.pack('!H', resp),
-                                 struct.pack('!B', length),
-                                 value)
-        raw_message = struct.pack('!HHB{}s'.format(len(value)), resp, length, checksum, value)
-        enc_msg = self.zigate_encode(raw_message)
-        enc_msg.insert(0, 0x01)
-        enc_msg.append(0x03)
-        enc_msg = bytes(enc_msg)
-        return enc_msg
+        return encode_message(resp, value)
 
     def checksum(self, *args):
-        chcksum = 0
-        for arg in args:
-            if isinstance(arg, int):
-                chcksum ^= arg
-                continue
-            for x in arg:
-                chcksum ^= x
-        return chcksum
+        return checksum(*args)
 
     def zigate_encode(self, data):
-        encoded = bytearray()
-        for b in data:
-            if b < 0x10:
-                encoded.extend([0x02, 0x10 ^ b])
-            else:
-                encoded.append(b)
-        return encoded
+        return bytearray(zigate_encode(data))
 
     def zigate_decode(self, data):
-        flip = False
-        decoded = bytearray()
-        for b in data:
-            if flip:
-                flip = False
-                decoded.append(b ^ 0x10)
-            elif b == 0x02:
-                flip = True
-            else:
-                decoded.append(b)
-        return decoded
+        return bytearray(zigate_decode(data))
 
     def get_last_cmd(self):
         if not self.sent:
             return
         cmd = self.sent[-1]
-        data = self.zigate_decode(cmd[1:-1])[5:]
+        data = zigate_decode(cmd[1:-1])[5:]
         return data
 
 
@@ -195,6 +165,10 @@ class ThreadSerialConnection(BaseTransport):
         self.serial = None
         self._search_re = search_re
         self._running = True
+        # self-pipe used to wake up the listen thread when data has to be sent
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
         self.reconnect(False)
         self.thread = threading.Thread(target=self.listen,
                                        name='ZiGate-Listen')
@@ -207,6 +181,7 @@ class ThreadSerialConnection(BaseTransport):
 
     def vid_pid(self):
         if self.serial:
+            import serial.tools.list_ports
             port = list(serial.tools.list_ports.grep(self.serial.port))[0]
             return (port.vid, port.pid)
         return BaseTransport.vid_pid(self)
@@ -238,20 +213,56 @@ class ThreadSerialConnection(BaseTransport):
             if delay < 30:
                 delay *= 1.5
 
+    def send(self, data):
+        self.queue.put(data)
+        self._wakeup()
+
+    def _wakeup(self):
+        '''
+        wake up the listen thread
+        '''
+        try:
+            os.write(self._wakeup_w, b'\x00')
+        except (BlockingIOError, OSError):
+            pass  # pipe already full or closed, thread will wake up anyway
+
+    def _clear_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _wait_io(self, timeout=None):
+        '''
+        block until serial has data to read or something has to be sent
+        return True if serial is readable
+        '''
+        readable, _, _ = select.select([self.serial, self._wakeup_r], [], [], timeout)
+        if self._wakeup_r in readable:
+            self._clear_wakeup()
+        return self.serial in readable
+
+    def _write_queue(self):
+        while not self.queue.empty():
+            data = self.queue.get()
+            self.serial.write(data)
+
     def listen(self):
         while self._running:
             try:
-                data = self.serial.read(self.serial.in_waiting)
+                self._write_queue()
+                data = None
+                if self._wait_io():
+                    data = self.serial.read(self.serial.in_waiting or 1)
             except Exception:
                 data = None
+                if not self._running:
+                    break
                 LOGGER.error('OOPS connection lost, reconnect...')
                 self.reconnect()
             if data:
                 self.read_data(data)
-            while not self.queue.empty():
-                data = self.queue.get()
-                self.serial.write(data)
-            time.sleep(0.05)
 
     def _find_port(self, port):
         '''
@@ -260,6 +271,7 @@ class ThreadSerialConnection(BaseTransport):
         port = port or 'auto'
         if port == 'auto':
             LOGGER.info('Searching ZiGate port')
+            import serial.tools.list_ports
             devices = list(serial.tools.list_ports.grep(self._search_re))
             if devices:
                 port = devices[0].device
@@ -280,13 +292,17 @@ class ThreadSerialConnection(BaseTransport):
 
     def close(self):
         self._running = False
-        tries = 0
-        while self.thread.is_alive():
-            tries += 1
-            if tries > 50:
-                break
-            time.sleep(0.1)
+        self._wakeup()
+        self.thread.join(5)
         self.serial.close()
+        self._close_wakeup()
+
+    def _close_wakeup(self):
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
 
 
 class ThreadSocketConnection(ThreadSerialConnection):
@@ -332,40 +348,39 @@ class ThreadSocketConnection(ThreadSerialConnection):
                 pass
         ThreadSerialConnection.reconnect(self, retry=retry)
 
+    def _write_queue(self):
+        while not self.queue.empty():
+            data = self.queue.get()
+            self.serial.sendall(data)
+
     def listen(self):
         while self._running:
-            socket_list = [self.serial]
-            read_sockets, write_sockets, error_sockets = select.select(socket_list, socket_list, [], 5)
-            if read_sockets:
-                data = self.serial.recv(1024)
-                if data:
-                    self.read_data(data)
-                else:
-                    LOGGER.warning('OOPS connection lost, reconnect...')
-                    self.reconnect()
-            if write_sockets:
-                while not self.queue.empty():
-                    data = self.queue.get()
-                    try:
-                        self.serial.send(data)
-                    except OSError:
-                        LOGGER.warning('OOPS connection lost, reconnect...')
-                        self.reconnect()
-            time.sleep(0.05)
+            try:
+                self._write_queue()
+                data = None
+                if self._wait_io():
+                    data = self.serial.recv(1024)
+                    if not data:
+                        raise ConnectionResetError('Connection closed by ZiGate')
+            except (OSError, ValueError):
+                if not self._running:
+                    break
+                LOGGER.warning('OOPS connection lost, reconnect...')
+                self.reconnect()
+                continue
+            if data:
+                self.read_data(data)
 
     def is_connected(self):
         return self._is_connected
 
     def close(self):
         self._running = False
-        tries = 0
-        while self.thread.is_alive():
-            tries += 1
-            if tries > 50:
-                break
-            time.sleep(0.1)
+        self._wakeup()
+        self.thread.join(5)
         self.serial.shutdown(2)
         self.serial.close()
+        self._close_wakeup()
 
 
 def discover_host():